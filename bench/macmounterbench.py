@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+# Simulates macmounter against thousands of synthetic sections, on a virtual
+# clock, with fake commands standing in for ping/mount/test. Nothing is
+# actually pinged, mounted or spawned, so this runs on any box.
+#
+#   $ python bench/macmounterbench.py --sections 2000 --hours 24
+#
+# The daemon's own mountrecord check logic is driven by a timer heap, like
+# the scheduler engine does. Its time module and command executor are
+# swapped for the fakes below.
+#
+# Only the check logic is real. The scheduler engine, its workers, the
+# threads engine, the network monitor and the reachability prober are not
+# run: simscheduler models a scheduler that always has a free worker, the
+# sections only ever ping through PING_CMD, and the threads engine's wakeups
+# are worked out from its one wakeup per section per second, not measured.
+
+import os
+import sys
+import imp
+import argparse
+import logging
+import tempfile
+import shutil
+import random
+import heapq
+import bisect
+import itertools
+import resource
+import signal
+import json
+import time
+
+macmounterPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "macmounter.py")
+
+def setupParser ():
+    parser = argparse.ArgumentParser(description='Simulate macmounter against synthetic sections.')
+    parser.add_argument("-n", "--sections", help="Number of sections", type=int, default=1000)
+    parser.add_argument("--hosts", help="Number of servers the sections mount from", type=int, default=100)
+    parser.add_argument("--hours", help="Simulated hours", type=float, default=24)
+    parser.add_argument("--interval", help="RECHECK_INTERVAL_SECONDS of every section", type=int, default=300)
+    parser.add_argument("--mtbf", help="Mean seconds between outages of a server", type=float, default=6 * 3600)
+    parser.add_argument("--mttr", help="Mean seconds a server outage lasts", type=float, default=600)
+    parser.add_argument("--drops", help="Mean seconds between a single mount going away on its own", type=float, default=24 * 3600)
+    parser.add_argument("--netchanges", help="Mean seconds between network changes on this machine (0 for none)", type=float, default=4 * 3600)
+    parser.add_argument("--netdown", help="Seconds the network is gone for at every network change", type=float, default=30)
+    parser.add_argument("--netdebounce", help="Seconds the network monitor waits before rechecking", type=float, default=2)
+    parser.add_argument("--pinglatency", help="Seconds a successful ping takes", type=float, default=0.02)
+    parser.add_argument("--mountlatency", help="Seconds a successful mount takes", type=float, default=1.5)
+    parser.add_argument("--testlatency", help="Seconds a mount test takes", type=float, default=0.01)
+    parser.add_argument("--mountfailures", help="Chance that a mount fails although its server is up", type=float, default=0.05)
+    parser.add_argument("--hangs", help="Chance that a command against a server that is down hangs until its timeout", type=float, default=0.2)
+    parser.add_argument("--hooks", help="Give every section a MOUNT_SUCCESS_CMD and MOUNT_FAILURE_CMD", action="store_true", default=False)
+    parser.add_argument("-o", "--option", help="Extra section option, as KEY=VALUE. Can be repeated.", action="append", default=[])
+    parser.add_argument("--seed", help="Random seed", type=int, default=1)
+    parser.add_argument("--loglevel", help="Log level of the daemon's logger (logs go nowhere)", choices=['debug', 'info', 'warning', 'error', 'critical'], default='critical')
+    parser.add_argument("--json", help="Print the report as JSON", action="store_true", default=False)
+    return parser
+
+class virtualclock (object):
+    """Stands in for the time module. sleep() and commands advance now."""
+    def __init__ (self):
+        self.now = 0.0
+
+    def time (self):
+        return self.now
+
+    def sleep (self, seconds):
+        self.now += seconds
+
+    def ctime (self, seconds=None):
+        return "T+%.3f" % (self.now if seconds is None else seconds)
+
+    def strftime (self, format, t=None):
+        return time.strftime(format, time.gmtime(0))
+
+class outages (object):
+    """Random down times of one thing over the simulated period."""
+    def __init__ (self, rng, mtbf, mttr, duration):
+        self.starts = []
+        self.ends = []
+        if not mtbf:
+            return
+        t = rng.expovariate(1.0 / mtbf)
+        while t < duration:
+            self.starts.append(t)
+            t += rng.expovariate(1.0 / mttr) if mttr else 0
+            self.ends.append(t)
+            t += rng.expovariate(1.0 / mtbf)
+
+    def down (self, now):
+        i = bisect.bisect_right(self.starts, now) - 1
+        return i >= 0 and now < self.ends[i]
+
+    def nextStart (self, after):
+        i = bisect.bisect_right(self.starts, after)
+        return self.starts[i] if i < len(self.starts) else None
+
+class share (object):
+    __slots__ = ('name', 'host', 'drops', 'mountedat', 'lostat', 'detectedat')
+
+    def __init__ (self, name, host, drops):
+        self.name = name
+        self.host = host
+        self.drops = drops
+        self.mountedat = None
+        self.lostat = None
+        self.detectedat = None
+
+class world (object):
+    """The servers and shares the fake commands act on. A mount is lost when
+    its server goes down, when the network goes away, or on its own."""
+    def __init__ (self, args, clock, duration):
+        rng = random.Random(args.seed)
+        self.args = args
+        self.clock = clock
+        self.rng = rng
+        self.network = outages(rng, args.netchanges, args.netdown if args.netchanges else 0, duration)
+        self.hosts = dict()
+        for h in range(args.hosts):
+            self.hosts['h' + str(h)] = outages(rng, args.mtbf, args.mttr, duration)
+        self.shares = dict()
+        for i in range(args.sections):
+            name = 's' + str(i)
+            self.shares[name] = share(name, 'h' + str(i % args.hosts), outages(rng, args.drops, 0, duration))
+        self.detections = []
+        self.remounts = []
+        self.coldmounts = []
+
+    def up (self, host, now):
+        return not self.hosts[host].down(now) and not self.network.down(now)
+
+    def lostAt (self, s):
+        # First thing that took the mount away after it was mounted
+        causes = [outage.nextStart(s.mountedat) for outage in (self.hosts[s.host], self.network, s.drops)]
+        causes = [t for t in causes if t is not None]
+        return min(causes) if causes else None
+
+    def mounted (self, s, now):
+        if s.mountedat is None:
+            return False
+        if s.lostat is None:
+            s.lostat = self.lostAt(s) or float('inf')
+        return now < s.lostat
+
+    def ping (self, host, now):
+        if self.up(host, now):
+            return 0, self.args.pinglatency
+        return self.hang() or (1, self.args.pinglatency)
+
+    def test (self, s, now):
+        if self.mounted(s, now):
+            return 0, self.args.testlatency
+        if s.mountedat is not None and s.detectedat is None:
+            s.detectedat = now
+            self.detections.append(now - s.lostat)
+        if s.mountedat is not None and not self.up(s.host, now):
+            # Stale mount of a server that is gone
+            return self.hang() or (1, self.args.testlatency)
+        return 1, self.args.testlatency
+
+    def mount (self, s, now):
+        if not self.up(s.host, now):
+            return self.hang() or (1, self.args.mountlatency)
+        if self.rng.random() < self.args.mountfailures:
+            return 1, self.args.mountlatency
+        done = now + self.args.mountlatency
+        if s.mountedat is None:
+            self.coldmounts.append(done)
+        elif not self.mounted(s, now):
+            self.remounts.append(done - s.lostat)
+        s.mountedat = done
+        s.lostat = None
+        s.detectedat = None
+        return 0, self.args.mountlatency
+
+    def hang (self):
+        if self.rng.random() < self.args.hangs:
+            return None, None
+        return None
+
+class fakeexecutor (object):
+    """Stands in for the daemon's executor. Runs "fake <ping|test|mount|hook>
+    <name>" against the world, advancing the clock by how long the command
+    would have taken."""
+    def __init__ (self, world, clock):
+        self.world = world
+        self.clock = clock
+        self.children = dict()
+        self.stats = dict() # kind => [count, failures, timeouts, seconds]
+
+    def execute (self, cmd, logPrefix="", timeout=None, kind=None, env=None, capture=None, outputmode=None):
+        argv = cmd.split()
+        now = self.clock.now
+        if argv[:1] != ['fake'] or len(argv) < 3:
+            rc, latency = 0, 0.001
+        elif argv[1] == 'ping':
+            rc, latency = self.world.ping(argv[2], now)
+        elif argv[1] == 'test':
+            rc, latency = self.world.test(self.world.shares[argv[2]], now)
+        elif argv[1] == 'mount':
+            rc, latency = self.world.mount(self.world.shares[argv[2]], now)
+        else:
+            rc, latency = 0, 0.001
+        outcome = 'ok' if rc == 0 else 'failed'
+        if latency is None:
+            # Hung until killed
+            latency = timeout or 0
+            outcome = 'timeout'
+        self.clock.sleep(latency)
+        self.record(kind, outcome, latency)
+        return rc, ''
+
+    def killAll (self):
+        pass
+
+    def record (self, kind, outcome, duration):
+        stats = self.stats.setdefault(kind or 'OTHER', [0, 0, 0, 0.0])
+        stats[0] += 1
+        if outcome == 'failed':
+            stats[1] += 1
+        elif outcome == 'timeout':
+            stats[2] += 1
+        stats[3] += duration
+
+class simscheduler (object):
+    """Stands in for the scheduler engine, minus its threads. Every check runs
+    at its due time, as if there were always a free worker."""
+    def __init__ (self, clock):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeups = 0
+        self.checks = 0
+
+    def add (self, record):
+        record.updateCurrentInterval()
+        self.schedule(record, record.startDelay())
+
+    def schedule (self, record, delay):
+        record.due = self.clock.now + delay
+        record.generation += 1
+        heapq.heappush(self.heap, (record.due, next(self.counter), record.generation, record))
+
+    def at (self, due, fn):
+        heapq.heappush(self.heap, (due, next(self.counter), None, fn))
+
+    def stop (self):
+        pass
+
+    def run (self, duration):
+        lastdue = None
+        while self.heap and self.heap[0][0] <= duration:
+            due, count, generation, record = heapq.heappop(self.heap)
+            if generation is not None and generation != record.generation:
+                continue
+            self.clock.now = due
+            if due != lastdue:
+                self.wakeups += 1
+                lastdue = due
+            if generation is None:
+                record()
+                continue
+            self.checks += 1
+            record.check()
+            if record.reload:
+                self.schedule(record, 0)
+            else:
+                self.schedule(record, record.currentinterval)
+
+class fakenetworksource (object):
+    """Replays the world's network outages as network change events, which
+    reach the daemon after the network monitor's debounce."""
+    def __init__ (self, world, debounce):
+        self.world = world
+        self.debounce = debounce
+
+    def attach (self, sched, callback):
+        for t in self.world.network.starts + self.world.network.ends:
+            sched.at(t + self.debounce, callback)
+
+def writeConfig (args, directory):
+    filename = os.path.join(directory, "bench.conf")
+    with open(filename, 'w') as f:
+        for i in range(args.sections):
+            f.write("[s%d]\n" % i)
+            f.write("PING_CMD=fake ping h%d\n" % (i % args.hosts))
+            f.write("MOUNT_TEST_CMD=fake test s%d\n" % i)
+            f.write("MOUNT_CMD=fake mount s%d\n" % i)
+            f.write("RECHECK_INTERVAL_SECONDS=%d\n" % args.interval)
+            if args.hooks:
+                f.write("MOUNT_SUCCESS_CMD=fake hook s%d\n" % i)
+                f.write("MOUNT_FAILURE_CMD=fake hook s%d\n" % i)
+            for option in args.option:
+                f.write(option + "\n")
+    return filename
+
+def percentile (values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def loadMacmounter (clock, executor, sched, loglevel):
+    macmounter = imp.load_source('macmounter', macmounterPath)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    macmounter.logger.addHandler(logging.NullHandler())
+    macmounter.logger.setLevel(getattr(logging, loglevel.upper()))
+    macmounter.logger.propagate = False
+    macmounter.time = clock
+    macmounter.commandExecutor = executor
+    macmounter.mounterScheduler = sched
+    return macmounter
+
+def report (args, results):
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+        return
+    def seconds (value):
+        return "-" if value is None else "%.1fs" % value
+    print "Simulated %(sections)d sections on %(hosts)d servers for %(hours).1f hours" % results
+    print "  (engines, network monitor and reachability prober are modelled, not run)"
+    print "  CPU time:               %.2fs (%.1f us per check)" % (results['cputime'], results['cpuperchecksec'] * 1e6)
+    print "  Max RSS:                %d KB" % results['maxrsskb']
+    print "  Checks:                 %d" % results['checks']
+    print "  Modelled wakeups/sec:   %.3f scheduler, %.1f threads engine" % (results['modelledwakeupspersec'], results['modelledthreadwakeupspersec'])
+    print "  Process spawns:         %d (%.2f per second)" % (results['spawns'], results['spawnspersec'])
+    for kind, values in sorted(results['commands'].items()):
+        print "    %-22s %d run, %d failed, %d timed out" % (kind, values[0], values[1], values[2])
+    print "  Mounts lost:            %d, remounted %d" % (results['lost'], results['remounted'])
+    print "  Loss to detection:      p50 %s, p99 %s, max %s" % tuple(seconds(v) for v in results['detection'])
+    print "  Loss to remount:        p50 %s, p99 %s, max %s" % tuple(seconds(v) for v in results['remount'])
+    print "  Start to all mounted:   %s" % seconds(results['allmounted'])
+
+def crux ():
+    parser = setupParser()
+    args = parser.parse_args()
+    random.seed(args.seed)
+    duration = args.hours * 3600
+
+    clock = virtualclock()
+    sim = world(args, clock, duration)
+    executor = fakeexecutor(sim, clock)
+    sched = simscheduler(clock)
+    macmounter = loadMacmounter(clock, executor, sched, args.loglevel)
+
+    directory = tempfile.mkdtemp(prefix="macmounterbench")
+    try:
+        filename = writeConfig(args, directory)
+        parsed = macmounter.readConfig(filename)
+        cpu = os.times()
+        for section in parsed.sections:
+            sched.add(macmounter.mountrecord(section, filename))
+        fakenetworksource(sim, args.netdebounce).attach(sched, macmounter.recheckOnNetworkChange)
+        sched.run(duration)
+        cpu = sum(os.times()[:2]) - sum(cpu[:2])
+    finally:
+        shutil.rmtree(directory)
+
+    spawns = sum(values[0] for values in executor.stats.values())
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    lost = len(sim.detections)
+    report(args, {
+        'sections': args.sections,
+        'hosts': args.hosts,
+        'hours': args.hours,
+        'cputime': cpu,
+        'cpuperchecksec': cpu / max(1, sched.checks),
+        'maxrsskb': maxrss,
+        'checks': sched.checks,
+        # Neither engine runs here. The scheduler figure counts the distinct
+        # due times of simscheduler's heap, and the threads engine wakes every
+        # mounter once a second no matter what.
+        'modelledwakeupspersec': sched.wakeups / duration,
+        'modelledthreadwakeupspersec': float(args.sections),
+        'spawns': spawns,
+        'spawnspersec': spawns / duration,
+        'commands': executor.stats,
+        'lost': lost,
+        'remounted': len(sim.remounts),
+        'detection': [percentile(sim.detections, 50), percentile(sim.detections, 99), max(sim.detections or [None])],
+        'remount': [percentile(sim.remounts, 50), percentile(sim.remounts, 99), max(sim.remounts or [None])],
+        'allmounted': max(sim.coldmounts) if len(sim.coldmounts) == args.sections else None,
+    })
+
+if __name__ == "__main__":  crux()
@@ -15,18 +15,39 @@ import threading
 import signal
 import traceback
 import shlex
-
+import heapq
+import fcntl
+import select
+import errno
+import Queue
+import struct
+import ctypes
+import ctypes.util
+import re
+import socket
+import random
+import BaseHTTPServer
+import json
+import pipes
+import hashlib
+import imp
+import collections
+import urllib
+import sqlite3
+
+# Signal handlers interrupt the main thread, which may be holding any lock.
+# They only hand the signal over, and the main loop acts on it.
 def ctrlc_handler (signal, frame):
-    global running
-    logger.info('You pressed Ctrl+C!')
-    running = False
-    killMounters()
+    daemonLifecycle.request('INT')
+
+def term_handler (signal, frame):
+    daemonLifecycle.request('TERM')
+
+def usr1_handler (signal, frame):
+    daemonLifecycle.request('USR1')
 
 def hup_handler (signal, frame):
-    logger.info('Caught signal HUP. macmounter restarted!')
-    launchMounters(updateConfig())
-    for mounter in mounterMap.values():
-        mounter.reload = True # This triggers the mounter to restart
+    daemonLifecycle.request('HUP')
 
 # Global variables are evil. Except these.
 logger = logging.getLogger("macmounter")
@@ -36,6 +57,12 @@ DEFAULT_RECHECK_INTERVAL_SECONDS = 300
 DEFAULT_WAKE_ATTEMPTS = 2
 DEFAULT_MOUNT_TEST_CMD = None
 DEFAULT_PING_CMD = None
+DEFAULT_PING_HOST = None
+DEFAULT_PING_PORT = None
+DEFAULT_PING_TIMEOUT = 3
+DEFAULT_PING_CACHE_SECONDS = 10
+# How much longer than its timeout anyone waits on a probe
+PROBE_WAIT_MARGIN_SECONDS = 5
 DEFAULT_PING_SUCCESS_CMD = None
 DEFAULT_PING_FAILURE_CMD = None
 DEFAULT_WAKE_CMD = None
@@ -46,11 +73,114 @@ DEFAULT_LOST_MOUNT_CMD = None
 DEFAULT_FOUND_MOUNT_CMD = None
 DEFAULT_MOUNT_SUCCESS_CMD = None
 DEFAULT_MOUNT_FAILURE_CMD = None
+DEFAULT_MOUNT_CMD_TIMEOUT = 120
+DEFAULT_MOUNT_TEST_CMD_TIMEOUT = 30
+DEFAULT_PING_CMD_TIMEOUT = 30
+DEFAULT_HOOK_CMD_TIMEOUT = 60
+DEFAULT_UNMOUNT_CMD = None
+DEFAULT_UNMOUNT_CMD_TIMEOUT = 30
+DEFAULT_HEALTH_PROBE = False
+DEFAULT_HEALTH_PROBE_PATH = None
+DEFAULT_HEALTH_PROBE_TIMEOUT = 5
+HEALTH_PROBE_ARGV = ['ls', '-a']
+KILL_GRACE_SECONDS = 1
+DEFAULT_MAX_CHILDREN = 32
+DEFAULT_DEPENDS_ON = None
+DEFAULT_CREDENTIALS = None
+DEFAULT_CREDENTIALS_TTL_SECONDS = 3600
+DEFAULT_HOOK_MODE = 'level'
+DEFAULT_HOOK_DEBOUNCE_SECONDS = 30
+HOOK_MODES = ['level', 'edge', 'debounce']
+DEFAULT_MOUNT_CONCURRENCY = 8
+COMMAND_POLL_SECONDS = 0.25
+DEFAULT_OUTPUT_CAPTURE_BYTES = 4096
+DEFAULT_OUTPUT_MODE = 'tail'
+OUTPUT_MODES = ['tail', 'discard', 'log']
+SHELL_METACHARACTERS = re.compile(r'[|&;<>()$`\\*?\[\]{}~!#\n]')
+# POSIX special and regular builtins, and the common bash/zsh ones
+SHELL_BUILTINS = ['.', ':', 'alias', 'bg', 'break', 'builtin', 'cd', 'command', 'continue', 'declare', 'eval', 'exec', 'exit',
+                  'export', 'false', 'fc', 'fg', 'getopts', 'hash', 'jobs', 'kill', 'let', 'local', 'newgrp', 'pwd', 'read',
+                  'readonly', 'return', 'set', 'shift', 'source', 'times', 'trap', 'true', 'type', 'typeset', 'ulimit',
+                  'umask', 'unalias', 'unset', 'wait']
+DEFAULT_BACKOFF_MULTIPLIER = 1
+DEFAULT_BACKOFF_MAX_SECONDS = 3600
+DEFAULT_BACKOFF_JITTER = False
+DEFAULT_START_JITTER_SECONDS = 0
+DEFAULT_ADAPTIVE_INTERVAL = False
+DEFAULT_ADAPTIVE_INTERVAL_MIN_SECONDS = 30
+DEFAULT_ADAPTIVE_INTERVAL_MAX_SECONDS = 3600
+DEFAULT_ADAPTIVE_INTERVAL_GROWTH = 1.5
+DEFAULT_ADAPTIVE_FLAP_WINDOW_SECONDS = 3600
+ADAPTIVE_FLAP_HISTORY = 32
+DEFAULT_HOST = None
+DEFAULT_BREAKER_THRESHOLD = 0
+DEFAULT_BREAKER_COOLDOWN_SECONDS = 300
+DEFAULT_MOUNT_POINT = None
+DEFAULT_MOUNT_FSTYPE = None
+DEFAULT_MOUNT_SOURCE = None
+MOUNT_TABLE_TTL_SECONDS = 1
+MOUNTINFO_FILE = "/proc/self/mountinfo"
+MOUNT_TABLE_CMD = "/sbin/mount"
+DEFAULT_ENGINE = 'threads'
+DEFAULT_SCHEDULER_WORKERS = 16
+DEFAULT_WATCHER = 'auto'
+DEFAULT_NETWORK_MONITOR = 'auto'
+DEFAULT_METRICS_ADDRESS = '127.0.0.1'
+CHECK_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DEFAULT_NETWORK_DEBOUNCE_SECONDS = 2
+DEFAULT_NETWORK_MIN_GAP_SECONDS = 10
+DEFAULT_RECHECK_ON_NETWORK_CHANGE = True
+WATCHER_SETTLE_SECONDS = 0.05
 homeConfigFolder = os.path.join(os.path.expanduser("~"), ".macmounter")
 homeConfigFile = os.path.join(os.path.expanduser("~"), ".macmounter.conf")
+homeControlSocket = os.path.join(os.path.expanduser("~"), ".macmounter.sock")
+CONTROL_COMMANDS = ['status', 'reload', 'recheck', 'pause', 'resume', 'profile']
+CONTROL_TIMEOUT_SECONDS = 10
+DEFAULT_SHUTDOWN_TIMEOUT_SECONDS = 10
+DEFAULT_LOG_FORMAT = 'text'
+DEFAULT_LOG_REPEAT_SECONDS = 600
+LOG_QUEUE_SIZE = 10000
+LOG_FLUSH_SECONDS = 5
+LOG_TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(thread)d - %(message)s'
+homeCredentialsFile = os.path.join(os.path.expanduser("~"), ".macmounter.credentials")
+homeCredentialsKeyFile = os.path.join(os.path.expanduser("~"), ".macmounter.credentials.key")
+# Files the daemon writes itself live outside of $HOME, which is watched for
+# ~/.macmounter.conf and ~/.macmounter appearing
+if sys.platform == 'darwin':
+    homeRuntimeFolder = os.path.join(os.path.expanduser("~"), "Library/Application Support/macmounter")
+else:
+    homeRuntimeFolder = os.path.join(os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser("~"), ".local/state"), "macmounter")
+homeStateFile = os.path.join(homeRuntimeFolder, "macmounter.state")
+STATE_SAVE_DELAY_SECONDS = 1
+homeHistoryFile = os.path.join(homeRuntimeFolder, "macmounter.history")
+DEFAULT_HISTORY_ROWS = 100000
+DEFAULT_HISTORY_WINDOW_SECONDS = 86400
+HISTORY_QUEUE_SIZE = 10000
+HISTORY_BATCH_SIZE = 500
+HISTORY_FLUSH_SECONDS = 1
+HISTORY_STEPS = {'PING_CMD': 'ping', 'MOUNT_TEST_CMD': 'test', 'MOUNT_CMD': 'mount'}
+DEFAULT_TRACE_EVENTS = 1000000
+TRACE_QUEUE_SIZE = 10000
+homeProfileFile = os.path.join(homeRuntimeFolder, "macmounter.profile")
+PROFILE_SAMPLE_SECONDS = 0.01
 
 # Actual global variables
 mounterMap = dict()
+configCache = dict()
+configCacheLock = threading.Lock()
+# Held while adding sections to and removing them from mounterMap. Configs are
+# launched from the main thread and from control commands.
+mounterMapLock = threading.RLock()
+mounterScheduler = None
+configWatcher = None
+monitorWakeup = None
+stateStore = None
+historyStore = None
+traceWriter = None
+profiler = None
+profileFile = homeProfileFile
+mountSlots = None
+logContext = threading.local()
 running = True
 
 # global configs
@@ -71,11 +201,49 @@ def setupParser ():
     parser.add_argument("-v", "--loglevel", help="Set log level", choices=loglevel, default='info')
     parser.add_argument("-m", "--macdefaults", help="Use mac defaults for logs", action="store_true", default=False)
     parser.add_argument("-o", "--nostdout", help="Do not display logs to stdout", action="store_true", default=False)
+    parser.add_argument("--logformat", help="Log as plain text, or as one JSON object per line", choices=['text', 'json'], default=DEFAULT_LOG_FORMAT)
+    parser.add_argument("--logrepeat", help="Log an identical info message at most once every this many seconds (0 to log every time)", type=float, default=DEFAULT_LOG_REPEAT_SECONDS)
+    parser.add_argument("--logsync", help="Write logs from the thread logging them, instead of a background thread", action="store_true", default=False)
     parser.add_argument("-r", "--reload", help="Reload currently running daemon (or mount all configured mounts now!)", action="store_true", default=False)
+    parser.add_argument("-e", "--engine", help="Mounter engine. 'threads' runs one thread per section, 'scheduler' runs all sections off a single timer heap", choices=['threads', 'scheduler'], default=DEFAULT_ENGINE)
+    parser.add_argument("-w", "--workers", help="Number of worker threads running checks for the scheduler engine", type=int, default=DEFAULT_SCHEDULER_WORKERS)
+    parser.add_argument("-x", "--maxchildren", help="Maximum number of commands running at the same time", type=int, default=DEFAULT_MAX_CHILDREN)
+    parser.add_argument("-k", "--mountconcurrency", help="Maximum number of mount commands running at the same time (0 for no limit)", type=int, default=DEFAULT_MOUNT_CONCURRENCY)
+    parser.add_argument("-n", "--netmonitor", help="How to watch for network changes. 'auto' uses rtnetlink on Linux and the routing socket on BSD/OS X", choices=['auto', 'rtnetlink', 'routesocket', 'none'], default=DEFAULT_NETWORK_MONITOR)
+    parser.add_argument("--netdebounce", help="Seconds to wait for the network to settle before rechecking", type=float, default=DEFAULT_NETWORK_DEBOUNCE_SECONDS)
+    parser.add_argument("--netmingap", help="Minimum seconds between two rechecks on network changes", type=float, default=DEFAULT_NETWORK_MIN_GAP_SECONDS)
+    parser.add_argument("-p", "--metricsport", help="Serve Prometheus metrics over HTTP on this port", type=int, default=None)
+    parser.add_argument("--metricsaddress", help="Address to serve Prometheus metrics on", default=DEFAULT_METRICS_ADDRESS)
+    parser.add_argument("-s", "--controlsocket", help="Unix socket to accept control commands on ('none' to disable)", default=homeControlSocket)
+    parser.add_argument("-C", "--ctl", help="Send a control command to the running daemon and print its reply", choices=CONTROL_COMMANDS, default=None)
+    parser.add_argument("--section", help="Section to send the control command for (default: all)", default=None)
+    parser.add_argument("--file", help="Config file to send the control command for (default: all)", default=None)
+    parser.add_argument("-S", "--statefile", help="File to keep section state in across restarts ('none' to disable)", default=homeStateFile)
+    parser.add_argument("-H", "--historyfile", help="SQLite file to record every check in ('none' to disable)", default=homeHistoryFile)
+    parser.add_argument("--historyrows", help="Number of checks to keep in the history file", type=int, default=DEFAULT_HISTORY_ROWS)
+    parser.add_argument("--history", help="Print flap rate, mount latency and availability from the history file, and exit", action="store_true", default=False)
+    parser.add_argument("--since", help="Seconds of history to print (default: one day)", type=float, default=DEFAULT_HISTORY_WINDOW_SECONDS)
+    parser.add_argument("--by", help="Print history per section or per host", choices=['section', 'host'], default='section')
+    parser.add_argument("--tracefile", help="Write a Chrome trace (chrome://tracing) of every check and command to this file", default=None)
+    parser.add_argument("--traceevents", help="Stop tracing after this many events", type=int, default=DEFAULT_TRACE_EVENTS)
+    parser.add_argument("--profilefile", help="File the profiler writes its samples to when it is stopped (SIGUSR1 or --ctl profile toggles it)", default=homeProfileFile)
+    parser.add_argument("-T", "--shutdowntimeout", help="Seconds to wait for checks and commands to finish when shutting down", type=float, default=DEFAULT_SHUTDOWN_TIMEOUT_SECONDS)
+    parser.add_argument("--credentialsttl", help="Seconds to keep credentials in memory before asking their provider again", type=float, default=DEFAULT_CREDENTIALS_TTL_SECONDS)
+    parser.add_argument("--credentialsfile", help="Encrypted credentials file for the 'file' credential provider", default=homeCredentialsFile)
+    parser.add_argument("--credentialskey", help="Key file for the encrypted credentials file", default=homeCredentialsKeyFile)
+    parser.add_argument("--hookplugin", help="Python file whose handle(event) function is called for every hook event. Can be repeated.", action="append", default=[])
+    parser.add_argument("-W", "--watcher", help="How to watch config files for changes. 'auto' uses inotify where available and polls otherwise", choices=['auto', 'inotify', 'poll'], default=DEFAULT_WATCHER)
     return parser
 
-def setupLogger (logger, loglevel, logfile, stdout = False, rollover = False, rotate = False, backupCount = 3, maxBytes = 2097152):
-    logger.setLevel(logging.DEBUG)
+def setupLogger (logger, loglevel, logfile, stdout = False, rollover = False, rotate = False, backupCount = 3, maxBytes = 2097152,
+                 logformat = DEFAULT_LOG_FORMAT, repeatSeconds = 0, asynchronous = False):
+    # Nothing below this level is logged anywhere, so don't even build the
+    # log records for it
+    logger.setLevel(min(logging.getLevelName(loglevel.upper()), logging.WARNING))
+    logger.addFilter(logcontext())
+    if repeatSeconds:
+        logger.addFilter(repeatfilter(repeatSeconds))
+    handlers = []
 
     #create a steam handler
     stdouthandler = logging.StreamHandler(sys.stdout)
@@ -87,11 +255,9 @@ def setupLogger (logger, loglevel, logfile, stdout = False, rollover = False, ro
 
     # create a logging format for stdout
     # stdoutformatter = logging.Formatter('%(message)s')
-    stdoutformatter = logging.Formatter('%(asctime)s - %(levelname)s - %(thread)d - %(message)s')
+    stdoutformatter = jsonformatter() if logformat == 'json' else logging.Formatter(LOG_TEXT_FORMAT)
     stdouthandler.setFormatter(stdoutformatter)
-
-    # add the stdout handler to the logger
-    logger.addHandler(stdouthandler)
+    handlers.append(stdouthandler)
 
     if logfile is not None:
         # create a file handler
@@ -108,14 +274,133 @@ def setupLogger (logger, loglevel, logfile, stdout = False, rollover = False, ro
 
         filehandler.setLevel(logging.getLevelName(loglevel.upper()))
         # create a logging format for the log file
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(thread)d - %(message)s')
+        formatter = jsonformatter() if logformat == 'json' else logging.Formatter(LOG_TEXT_FORMAT)
         filehandler.setFormatter(formatter)
+        handlers.append(filehandler)
 
-        # add the file handler to the logger
-        logger.addHandler(filehandler)
+    # add the handlers to the logger, or have them written from the background
+    if asynchronous:
+        logger.addHandler(queuehandler(handlers))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     return logger
 
+class logcontext (logging.Filter):
+    """Tags log records with the section the logging thread is checking."""
+    def filter (self, record):
+        current = getattr(logContext, 'record', None)
+        if current is not None and not hasattr(record, 'section'):
+            record.section = current.section
+            record.file = current.filename
+            record.state = current.state
+        return True
+
+class repeatfilter (logging.Filter):
+    """Lets an identical info (or debug) message through at most once every
+    window seconds, and says how many were held back when it next does. Float
+    arguments, which are timings, are ignored when comparing messages."""
+    def __init__ (self, window):
+        logging.Filter.__init__(self)
+        self.window = window
+        self.lock = threading.Lock()
+        self.seen = dict() # (msg, args) => [time last let through, repeats held back since]
+        self.pruned = time.time()
+
+    def filter (self, record):
+        if record.levelno > logging.INFO:
+            return True
+        args = record.args if isinstance(record.args, tuple) else ()
+        key = (record.msg, tuple(arg for arg in args if not isinstance(arg, float)))
+        now = record.created
+        try:
+            with self.lock:
+                if now - self.pruned >= self.window:
+                    self.seen = dict((k, v) for k, v in self.seen.items() if now - v[0] < self.window)
+                    self.pruned = now
+                entry = self.seen.get(key)
+                if entry is not None and now - entry[0] < self.window:
+                    entry[1] += 1
+                    return False
+                self.seen[key] = [now, 0]
+        except TypeError:
+            # Unhashable arguments
+            return True
+        if entry is not None and entry[1]:
+            record.msg = record.getMessage() + " (" + str(entry[1]) + " repeats not logged)"
+            record.args = ()
+        return True
+
+class queuehandler (logging.Handler):
+    """Hands log records to a background thread that formats and writes them,
+    so checks never wait on log I/O or on each other for the log lock. If
+    the writer falls LOG_QUEUE_SIZE records behind, records are dropped and
+    counted rather than blocking."""
+    def __init__ (self, handlers, size=LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = Queue.Queue(size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="logwriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit (self, record):
+        if record.exc_info:
+            # The traceback has to be rendered while it is still current
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run (self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.write(logging.makeLogRecord({'msg': "Log writer fell behind. Dropped " + str(dropped) + " log records.",
+                                                  'levelno': logging.WARNING, 'levelname': 'WARNING'}))
+            self.write(record)
+
+    def write (self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def close (self):
+        # Called by logging.shutdown() at exit. Write out what is queued first.
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, True, LOG_FLUSH_SECONDS)
+                self.thread.join(LOG_FLUSH_SECONDS)
+            except Queue.Full:
+                pass
+        for handler in self.handlers:
+            handler.flush()
+        logging.Handler.close(self)
+
+class jsonformatter (logging.Formatter):
+    """One JSON object per line, with the section, file, state, command kind
+    and duration as fields of their own where a record has them."""
+    FIELDS = ('section', 'file', 'state', 'kind', 'duration')
+
+    def format (self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'thread': record.thread, 'message': record.getMessage()}
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, sort_keys=True)
+
 def getConfFilesFromFolder (foldername, newerThanTime=0):
     logger.info("Looking for config files in: " + foldername)
     configFiles = []
@@ -132,21 +417,46 @@ def getConfFilesFromFolder (foldername, newerThanTime=0):
     return configFiles
 
 def operateOnSection(section, filename):
+    if mounterScheduler:
+        record = mountrecord(section, filename)
+        logger.info("Created record: " + str(record))
+        mounterScheduler.add(record)
+        return record
     mounterthread = mounter(section, filename)
     logger.info("Created thread: " + str(mounterthread))
     mounterthread.start()
     return mounterthread
 
 def operateOnFile(filename):
-    config = ConfigParser.ConfigParser()
-    config.read(filename)
+    if not os.path.isfile(filename):
+        logger.info("File " + filename + " is gone!")
+        for record in mounterMap.values():
+            if record.filename == filename:
+                record.stop()
+        return []
+    parsed = readConfig(filename)
+    if parsed is None:
+        return []
     threads = []
-    for section in config.sections():
+    for section in parsed.sections:
         logger.info("Found Section: " + section + ", filename: " + str(filename))
-        if section + filename not in mounterMap:
+        key = section + filename
+        if key not in mounterMap or not mounterMap[key].running:
+            # A stopped record that has not retired yet does not count
             threads.append(operateOnSection(section, filename))
+            continue
+        record = mounterMap[key]
+        if record.options != parsed.options[section]:
+            logger.info("Section " + section + " in file: " + filename + " has changed. Reloading.")
+            record.pendingoptions = (parsed.mtime, parsed.options[section])
+            record.recheck()
         else:
-            logger.info("Not recreating thread for section: " + section + " in file: " + filename)
+            logger.info("Section " + section + " in file: " + filename + " is unchanged.")
+            record.modifyTime = parsed.mtime
+    for record in mounterMap.values():
+        if record.filename == filename and record.section not in parsed.options:
+            logger.info("Section " + record.section + " has been removed from file: " + filename)
+            record.stop()
     return threads
 
 def get_absolute_path (path):
@@ -234,6 +544,9 @@ def updateConfig ():
 def killMounters ():
     for mounter in mounterMap.values():
         mounter.stop()
+    if mounterScheduler:
+        mounterScheduler.stop()
+    commandExecutor.close()
 
 def monitorConfigs ():
     global dotMacMounterDirConfMtime
@@ -242,7 +555,10 @@ def monitorConfigs ():
     global confDirMtime
 
     logger.info("Monitoring configs.")
-    while running:
+    while True:
+        daemonLifecycle.handleSignals()
+        if not running:
+            break
         configFiles = []
         if conffile or confdir:
             if conffile:
@@ -282,24 +598,319 @@ def monitorConfigs ():
             logger.info("Configs have changed!")
             launchMounters(configFiles)
         #logger.info("Sleeping...")
-        time.sleep(float(1))
+        monitorWakeup.wait(1)
         #logger.info("Done sleeping...")
     logger.info("Tango down. Config monitor thread dead.")
 
-def waitOnMounters ():
+def makeRuntimeFolder ():
+    try:
+        os.makedirs(homeRuntimeFolder, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            logger.error("Could not create " + homeRuntimeFolder + ": " + str(e))
+
+def getConfigRoots ():
+    # Returns (path, isdir) for everything updateConfig() reads configs from
+    if conffile or confdir:
+        roots = []
+        if conffile:
+            roots.append((conffile, False))
+        if confdir:
+            roots.append((confdir, True))
+        return roots
+    return [(homeConfigFile, False), (homeConfigFolder, True)]
+
+def setupConfigWatcher (watcher):
+    if watcher == 'poll':
+        return None
+    try:
+        return inotifywatcher(getConfigRoots())
+    except Exception as e:
+        if watcher == 'inotify':
+            logger.error("Could not set up inotify watcher: " + str(e))
+        logger.info("Falling back to polling configs.")
+        return None
+
+def watchConfigs (watcher):
+    logger.info("Watching configs with inotify.")
+    daemonLifecycle.handleSignals()
+    while running:
+        try:
+            ready = select.select([watcher.fileno(), monitorWakeup.fileno()], [], [])[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+        if watcher.fileno() not in ready:
+            monitorWakeup.clear()
+            daemonLifecycle.handleSignals()
+            continue
+        configFiles = watcher.read()
+        # Editors tend to write a file in a few steps, let them settle
+        while selfpipe.poll(watcher.fileno(), WATCHER_SETTLE_SECONDS):
+            configFiles.extend(watcher.read())
+        configFiles = sorted(set(configFiles))
+        if configFiles:
+            logger.info("Configs have changed! " + str(configFiles))
+            launchMounters(configFiles)
+    watcher.close()
+    logger.info("Tango down. Config watcher dead.")
+
+def setupNetworkMonitor (netmonitor, debounce, mingap=DEFAULT_NETWORK_MIN_GAP_SECONDS):
+    if netmonitor == 'none':
+        return None
+    if netmonitor == 'auto':
+        if sys.platform.startswith('linux'):
+            netmonitor = 'rtnetlink'
+        elif hasattr(socket, 'AF_ROUTE') or sys.platform == 'darwin' or 'bsd' in sys.platform:
+            netmonitor = 'routesocket'
+        else:
+            return None
+    try:
+        if netmonitor == 'rtnetlink':
+            source = rtnetlinksource()
+        else:
+            source = routesocketsource()
+    except Exception as e:
+        logger.error("Could not watch for network changes with " + netmonitor + ": " + str(e))
+        return None
+    monitor = networkmonitor(source, debounce, mingap=mingap)
+    monitor.start()
+    return monitor
+
+# networks lists the (family, packed address, prefix length) the change was
+# confined to, or is None if it may have changed the route to anywhere
+def recheckOnNetworkChange (networks=None):
+    # Cached pings and the mount table may both be out of date now
+    reachabilityCache.clear()
+    mountTable.invalidate()
+    addresses = dict() # host => its addresses, None if it does not resolve
+    rechecked = 0
+    for mounter in mounterMap.values():
+        if mounter.running and mounter.recheckonnetworkchange and isAffected(mounter.host, networks, addresses):
+            mounter.recheck()
+            rechecked += 1
+    logger.info("Rechecking %s sections after the network change.", rechecked)
+
+def isAffected (host, networks, addresses):
+    # Sections without a HOST (or PING_HOST) could be using any route
+    if networks is None or isBlank(host):
+        return True
+    if host not in addresses:
+        try:
+            addresses[host] = [(info[0], socket.inet_pton(info[0], info[4][0].split('%')[0]))
+                               for info in socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)]
+        except socket.error:
+            addresses[host] = None
+    if addresses[host] is None:
+        return True
+    for family, address in addresses[host]:
+        for netfamily, network, prefixlen in networks:
+            if family == netfamily and inNetwork(address, network, prefixlen):
+                return True
+    return False
+
+def inNetwork (address, network, prefixlen):
+    full, bits = divmod(prefixlen, 8)
+    if address[:full] != network[:full]:
+        return False
+    if bits:
+        mask = (0xff << (8 - bits)) & 0xff
+        return ord(address[full]) & mask == ord(network[full]) & mask
+    return True
+
+def escapeLabel (value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def renderMetrics ():
+    # Prometheus text exposition format
+    lines = []
+    now = time.time()
+    mounters = mounterMap.values()
+    lines.append("# HELP macmounter_mounters Number of live mounters.")
+    lines.append("# TYPE macmounter_mounters gauge")
+    lines.append("macmounter_mounters " + str(len(mounters)))
+    lines.append("# HELP macmounter_children_in_flight Number of commands running right now.")
+    lines.append("# TYPE macmounter_children_in_flight gauge")
+    lines.append("macmounter_children_in_flight " + str(len(commandExecutor.children)))
+    lines.append("# HELP macmounter_section_state Current state of each section.")
+    lines.append("# TYPE macmounter_section_state gauge")
+    for mounter in mounters:
+        labels = 'section="' + escapeLabel(mounter.section) + '",file="' + escapeLabel(mounter.filename) + '"'
+        for state in mounter.states:
+            lines.append('macmounter_section_state{' + labels + ',state="' + state + '"} ' + ('1' if mounter.state == state else '0'))
+    lines.append("# HELP macmounter_section_state_seconds Seconds each section has been in its current state.")
+    lines.append("# TYPE macmounter_section_state_seconds gauge")
+    for mounter in mounters:
+        labels = 'section="' + escapeLabel(mounter.section) + '",file="' + escapeLabel(mounter.filename) + '"'
+        lines.append('macmounter_section_state_seconds{' + labels + '} ' + ("%.3f" % (now - mounter.statesince)))
+    lines.append("# HELP macmounter_section_stale Whether the last mount test of each section found it stale, even if it was remounted since.")
+    lines.append("# TYPE macmounter_section_stale gauge")
+    for mounter in mounters:
+        labels = 'section="' + escapeLabel(mounter.section) + '",file="' + escapeLabel(mounter.filename) + '"'
+        lines.append('macmounter_section_stale{' + labels + '} ' + ('1' if mounter.stale else '0'))
+    lines.append("# HELP macmounter_section_interval_seconds Current recheck interval of each section, in seconds.")
+    lines.append("# TYPE macmounter_section_interval_seconds gauge")
+    for mounter in mounters:
+        labels = 'section="' + escapeLabel(mounter.section) + '",file="' + escapeLabel(mounter.filename) + '"'
+        lines.append('macmounter_section_interval_seconds{' + labels + '} ' + str(mounter.currentinterval or 0))
+    lines.append("# HELP macmounter_check_duration_seconds How long each check of a section took.")
+    lines.append("# TYPE macmounter_check_duration_seconds histogram")
+    for mounter in mounters:
+        labels = 'section="' + escapeLabel(mounter.section) + '",file="' + escapeLabel(mounter.filename) + '"'
+        lines.extend(mounter.checkdurations.render('macmounter_check_duration_seconds', labels))
+    stats = sorted(commandExecutor.stats.items())
+    for index, name, help in [(0, 'macmounter_command_spawns_total', 'Commands run, by command type.'),
+                              (1, 'macmounter_command_failures_total', 'Commands that returned non zero, by command type.'),
+                              (2, 'macmounter_command_timeouts_total', 'Commands killed for running too long, by command type.'),
+                              (3, 'macmounter_command_seconds_total', 'Seconds spent running commands, by command type.')]:
+        lines.append("# HELP " + name + " " + help)
+        lines.append("# TYPE " + name + " counter")
+        for kind, values in stats:
+            lines.append(name + '{kind="' + escapeLabel(kind) + '"} ' + str(values[index]))
+    return "\n".join(lines) + "\n"
+
+def setupMetricsServer (address, port):
+    server = BaseHTTPServer.HTTPServer((address, port), metricshandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on http://" + address + ":" + str(port) + "/metrics")
+    return server
+
+def sendControlCommand (path, request):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONTROL_TIMEOUT_SECONDS)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request) + "\n")
+        return json.loads(readLine(sock))
+    finally:
+        sock.close()
+
+def readLine (sock, limit=1048576):
+    data = ''
+    while not data.endswith("\n") and len(data) < limit:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def setupControlServer (path):
+    if os.path.exists(path):
+        try:
+            sendControlCommand(path, {'command': 'status', 'section': ''})
+            logger.error("Another macmounter is listening on " + path + ". Not starting the control socket.")
+            return None
+        except (socket.error, ValueError):
+            logger.info("Removing stale control socket " + path)
+            os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    oldmask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(oldmask)
+    sock.listen(5)
+    thread = threading.Thread(target=serveControl, args=(sock,), name="control")
+    thread.daemon = True
+    thread.start()
+    logger.info("Accepting control commands on " + path)
+    return sock
+
+def serveControl (sock):
+    while True:
+        try:
+            conn = sock.accept()[0]
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        try:
+            conn.settimeout(CONTROL_TIMEOUT_SECONDS)
+            try:
+                reply = handleControlCommand(json.loads(readLine(conn)))
+            except ValueError as e:
+                reply = {'ok': False, 'error': "Bad request: " + str(e)}
+            conn.sendall(json.dumps(reply) + "\n")
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            conn.close()
+
+def selectMounters (section=None, filename=None):
+    return [mounter for mounter in mounterMap.values()
+            if (section is None or mounter.section == section) and (filename is None or mounter.filename == filename)]
+
+def getDependents (record):
+    return [mounter for mounter in mounterMap.values() if mounter.running and mounter.dependson and record.section in mounter.dependson]
+
+def handleControlCommand (request):
+    command = request.get('command')
+    section = request.get('section')
+    filename = request.get('file')
+    logger.info("Control command: " + str(command) + " section: " + str(section) + " file: " + str(filename))
+    if command not in CONTROL_COMMANDS:
+        return {'ok': False, 'error': "Unknown command: " + str(command)}
+    if command == 'profile':
+        return toggleProfiler()
+    if command == 'reload':
+        if filename:
+            launchMounters([filename])
+        elif section is None:
+            launchMounters(updateConfig())
+    mounters = selectMounters(section, filename)
+    for mounter in mounters:
+        if command == 'pause':
+            mounter.pause()
+        elif command == 'resume':
+            mounter.resume()
+        elif command in ['reload', 'recheck']:
+            mounter.recheck()
+    return {'ok': True, 'sections': [mounter.status() for mounter in mounters]}
+
+# Starts the profiler, or stops it and writes out what it sampled
+def toggleProfiler ():
+    global profiler
+    if profiler is None:
+        logger.info("Starting profiler.")
+        profiler = sampler()
+        profiler.start()
+        return {'ok': True, 'profiling': True}
+    logger.info("Stopping profiler.")
+    current, profiler = profiler, None
+    current.stop()
+    try:
+        current.dump(profileFile)
+    except IOError as e:
+        logger.error("Could not write profile " + str(profileFile) + ": " + str(e))
+        return {'ok': False, 'profiling': False, 'error': str(e)}
+    logger.info("Wrote " + str(current.samples) + " profile samples to " + str(profileFile))
+    return {'ok': True, 'profiling': False, 'file': profileFile, 'samples': current.samples}
+
+def waitOnMounters (timeout=DEFAULT_SHUTDOWN_TIMEOUT_SECONDS):
     logger.info("Waiting on mounters: " + str(mounterMap.keys()))
     mounterMapCount = len(mounterMap)
     if mounterMapCount > 0:
         logger.info("Waiting on " + str(mounterMapCount) + " mounters!")
-        time.sleep(float(1))
+    if not daemonLifecycle.drain(timeout):
+        logger.error("Mounters still running after " + str(timeout) + " seconds. Leaving them behind.")
+    if historyStore:
+        historyStore.close(timeout)
+    if traceWriter:
+        traceWriter.close(timeout)
+    if profiler:
+        toggleProfiler()
     logger.info("Mounters eliminated.")
     logger.info("Dave, this conversation can serve no purpose anymore. Goodbye.")
 
 def launchMounters (configFiles):
     logger.info("Launching mounters... for configFiles: " + str(configFiles))
-    for filename in configFiles:
-        logger.info("Found file: " + str(filename))
-        operateOnFile(filename)
+    with mounterMapLock:
+        for filename in configFiles:
+            logger.info("Found file: " + str(filename))
+            operateOnFile(filename)
 
 def getConfig(config, section, option, default=None, ctype=str, logPrefix=""):
     ret = None
@@ -315,10 +926,178 @@ def getConfig(config, section, option, default=None, ctype=str, logPrefix=""):
     else:
         return None
 
+class parsedconfig (object):
+    """A config file parsed once, with the effective options of each section."""
+    __slots__ = ('filename', 'mtime', 'size', 'sections', 'options')
+
+    def __init__ (self, filename, mtime, size, previous=None):
+        self.filename = filename
+        self.mtime = mtime
+        self.size = size
+        try:
+            config = ConfigParser.ConfigParser()
+            config.read(filename)
+            sections = config.sections()
+            options = dict()
+            for section in sections:
+                options[section] = getSectionOptions(config, section)
+        except (ConfigParser.Error, ValueError) as e:
+            # A typo in a live config must not take the daemon down
+            logger.error("Could not parse config file " + filename + ": " + str(e) + ". Keeping its previous options.")
+            sections = previous.sections if previous else []
+            options = previous.options if previous else dict()
+        self.sections = sections
+        self.options = options
+
+def readConfig (filename):
+    # Returns the parsedconfig for filename, parsing it only if it changed
+    # since we last saw it. Returns None if the file is gone.
+    try:
+        st = os.stat(filename)
+    except OSError:
+        with configCacheLock:
+            configCache.pop(filename, None)
+        return None
+    with configCacheLock:
+        parsed = configCache.get(filename)
+        if parsed is None or parsed.mtime != st.st_mtime or parsed.size != st.st_size:
+            logger.info("Parsing config file: " + filename)
+            parsed = parsedconfig(filename, st.st_mtime, st.st_size, parsed)
+            configCache[filename] = parsed
+        return parsed
+
+def getSectionOptions (config, section):
+    logPrefix = "[" + section + "] "
+    options = dict()
+    options['interval'] = getConfig(config, section, 'RECHECK_INTERVAL_SECONDS', DEFAULT_RECHECK_INTERVAL_SECONDS, int, logPrefix=logPrefix)
+    options['intervalpingsuccess'] = getConfig(config, section, 'RECHECK_INTERVAL_SECONDS_PING_SUCCESS', options['interval'], int, logPrefix=logPrefix)
+    options['intervalpingfailure'] = getConfig(config, section, 'RECHECK_INTERVAL_SECONDS_PING_FAILURE', options['interval'], int, logPrefix=logPrefix)
+    options['intervalmountsuccess'] = getConfig(config, section, 'RECHECK_INTERVAL_SECONDS_MOUNT_SUCCESS', options['interval'], int, logPrefix=logPrefix)
+    options['intervalmountfailure'] = getConfig(config, section, 'RECHECK_INTERVAL_SECONDS_MOUNT_FAILURE', options['interval'], int, logPrefix=logPrefix)
+    options['mounttestcmd'] = getConfig(config, section, 'MOUNT_TEST_CMD', DEFAULT_MOUNT_TEST_CMD, logPrefix=logPrefix)
+    options['timeouts'] = {
+        'MOUNT_CMD': getConfig(config, section, 'MOUNT_CMD_TIMEOUT', DEFAULT_MOUNT_CMD_TIMEOUT, float, logPrefix=logPrefix),
+        'MOUNT_TEST_CMD': getConfig(config, section, 'MOUNT_TEST_CMD_TIMEOUT', DEFAULT_MOUNT_TEST_CMD_TIMEOUT, float, logPrefix=logPrefix),
+        'PING_CMD': getConfig(config, section, 'PING_CMD_TIMEOUT', DEFAULT_PING_CMD_TIMEOUT, float, logPrefix=logPrefix),
+        'UNMOUNT_CMD': getConfig(config, section, 'UNMOUNT_CMD_TIMEOUT', DEFAULT_UNMOUNT_CMD_TIMEOUT, float, logPrefix=logPrefix),
+        'HOOK': getConfig(config, section, 'HOOK_CMD_TIMEOUT', DEFAULT_HOOK_CMD_TIMEOUT, float, logPrefix=logPrefix),
+    }
+    options['mountpoint'] = getConfig(config, section, 'MOUNT_POINT', DEFAULT_MOUNT_POINT, get_absolute_path, logPrefix=logPrefix)
+    options['mountfstype'] = getConfig(config, section, 'MOUNT_FSTYPE', DEFAULT_MOUNT_FSTYPE, logPrefix=logPrefix)
+    options['mountsource'] = getConfig(config, section, 'MOUNT_SOURCE', DEFAULT_MOUNT_SOURCE, logPrefix=logPrefix)
+    options['healthprobe'] = getConfig(config, section, 'HEALTH_PROBE', DEFAULT_HEALTH_PROBE, getBoolean, logPrefix=logPrefix)
+    options['healthprobepath'] = getConfig(config, section, 'HEALTH_PROBE_PATH', options['mountpoint'] or DEFAULT_HEALTH_PROBE_PATH, get_absolute_path, logPrefix=logPrefix)
+    options['healthprobetimeout'] = getConfig(config, section, 'HEALTH_PROBE_TIMEOUT', DEFAULT_HEALTH_PROBE_TIMEOUT, float, logPrefix=logPrefix)
+    options['unmountcmd'] = getConfig(config, section, 'UNMOUNT_CMD', getUnmountCmd(options['mountpoint']), logPrefix=logPrefix)
+    options['pingcmd'] = getConfig(config, section, 'PING_CMD', DEFAULT_PING_CMD, logPrefix=logPrefix)
+    options['pinghost'] = getConfig(config, section, 'PING_HOST', DEFAULT_PING_HOST, logPrefix=logPrefix)
+    options['pingports'] = getConfig(config, section, 'PING_PORT', DEFAULT_PING_PORT, getPorts, logPrefix=logPrefix)
+    options['pingtimeout'] = getConfig(config, section, 'PING_TIMEOUT', DEFAULT_PING_TIMEOUT, float, logPrefix=logPrefix)
+    options['pingcacheseconds'] = getConfig(config, section, 'PING_CACHE_SECONDS', DEFAULT_PING_CACHE_SECONDS, float, logPrefix=logPrefix) or 0
+    # ICMP is the fallback, so by default only use it when there is no port to try
+    options['pingicmp'] = getConfig(config, section, 'PING_ICMP', not options['pingports'], getBoolean, logPrefix=logPrefix)
+    options['backoffmultiplier'] = getConfig(config, section, 'BACKOFF_MULTIPLIER', DEFAULT_BACKOFF_MULTIPLIER, float, logPrefix=logPrefix)
+    options['backoffmax'] = getConfig(config, section, 'BACKOFF_MAX_SECONDS', DEFAULT_BACKOFF_MAX_SECONDS, float, logPrefix=logPrefix)
+    options['backoffjitter'] = getConfig(config, section, 'BACKOFF_JITTER', DEFAULT_BACKOFF_JITTER, getBoolean, logPrefix=logPrefix)
+    options['startjitter'] = getConfig(config, section, 'START_JITTER_SECONDS', DEFAULT_START_JITTER_SECONDS, float, logPrefix=logPrefix)
+    options['adaptive'] = getConfig(config, section, 'ADAPTIVE_INTERVAL', DEFAULT_ADAPTIVE_INTERVAL, getBoolean, logPrefix=logPrefix)
+    options['adaptivemin'] = getConfig(config, section, 'ADAPTIVE_INTERVAL_MIN_SECONDS', DEFAULT_ADAPTIVE_INTERVAL_MIN_SECONDS, float, logPrefix=logPrefix)
+    options['adaptivemax'] = getConfig(config, section, 'ADAPTIVE_INTERVAL_MAX_SECONDS', DEFAULT_ADAPTIVE_INTERVAL_MAX_SECONDS, float, logPrefix=logPrefix)
+    options['adaptivegrowth'] = getConfig(config, section, 'ADAPTIVE_INTERVAL_GROWTH', DEFAULT_ADAPTIVE_INTERVAL_GROWTH, float, logPrefix=logPrefix)
+    options['adaptiveflapwindow'] = getConfig(config, section, 'ADAPTIVE_FLAP_WINDOW_SECONDS', DEFAULT_ADAPTIVE_FLAP_WINDOW_SECONDS, float, logPrefix=logPrefix)
+    options['recheckonnetworkchange'] = getConfig(config, section, 'RECHECK_ON_NETWORK_CHANGE', DEFAULT_RECHECK_ON_NETWORK_CHANGE, getBoolean, logPrefix=logPrefix)
+    options['host'] = getConfig(config, section, 'HOST', options['pinghost'] or DEFAULT_HOST, logPrefix=logPrefix)
+    options['breakerthreshold'] = getConfig(config, section, 'BREAKER_THRESHOLD', DEFAULT_BREAKER_THRESHOLD, int, logPrefix=logPrefix)
+    options['breakercooldown'] = getConfig(config, section, 'BREAKER_COOLDOWN_SECONDS', DEFAULT_BREAKER_COOLDOWN_SECONDS, float, logPrefix=logPrefix)
+    options['dependson'] = getConfig(config, section, 'DEPENDS_ON', DEFAULT_DEPENDS_ON, getNames, logPrefix=logPrefix)
+    options['premountcmd'] = getConfig(config, section, 'PRE_MOUNT_CMD', DEFAULT_PRE_MOUNT_CMD, logPrefix=logPrefix)
+    options['wakecmd'] = getConfig(config, section, 'WAKE_CMD', DEFAULT_WAKE_CMD, logPrefix=logPrefix)
+    options['wakeattempts'] = getConfig(config, section, 'WAKE_ATTEMPTS', DEFAULT_WAKE_ATTEMPTS, int, logPrefix=logPrefix)
+    options['mountcmd'] = getConfig(config, section, 'MOUNT_CMD', DEFAULT_MOUNT_CMD, logPrefix=logPrefix)
+    options['credentials'] = getConfig(config, section, 'CREDENTIALS', DEFAULT_CREDENTIALS, getCredentials, logPrefix=logPrefix)
+    options['outputcapture'] = getConfig(config, section, 'OUTPUT_CAPTURE_BYTES', DEFAULT_OUTPUT_CAPTURE_BYTES, int, logPrefix=logPrefix) or 0
+    options['outputmode'] = getConfig(config, section, 'OUTPUT_MODE', DEFAULT_OUTPUT_MODE, getOutputMode, logPrefix=logPrefix)
+    options['hookmode'] = getConfig(config, section, 'HOOK_MODE', DEFAULT_HOOK_MODE, getHookMode, logPrefix=logPrefix)
+    options['hookdebounce'] = getConfig(config, section, 'HOOK_DEBOUNCE_SECONDS', DEFAULT_HOOK_DEBOUNCE_SECONDS, float, logPrefix=logPrefix)
+    options['mountsuccesscmd'] = getConfig(config, section, 'MOUNT_SUCCESS_CMD', DEFAULT_MOUNT_SUCCESS_CMD, logPrefix=logPrefix)
+    options['mountfailurecmd'] = getConfig(config, section, 'MOUNT_FAILURE_CMD', DEFAULT_MOUNT_FAILURE_CMD, logPrefix=logPrefix)
+    options['postmountcmd'] = getConfig(config, section, 'POST_MOUNT_CMD', DEFAULT_POST_MOUNT_CMD, logPrefix=logPrefix)
+    options['lostmountcmd'] = getConfig(config, section, 'LOST_MOUNT_CMD', DEFAULT_LOST_MOUNT_CMD, logPrefix=logPrefix)
+    options['foundmountcmd'] = getConfig(config, section, 'FOUND_MOUNT_CMD', DEFAULT_FOUND_MOUNT_CMD, logPrefix=logPrefix)
+    return options
+
+def getUnmountCmd (mountpoint):
+    # Forced on OS X, lazy on Linux, so a hung filesystem can still be detached
+    if isBlank(mountpoint):
+        return DEFAULT_UNMOUNT_CMD
+    if sys.platform == 'darwin':
+        return "/sbin/umount -f " + pipes.quote(mountpoint)
+    return "umount -l " + pipes.quote(mountpoint)
+
+def getBootTime ():
+    # Seconds since the epoch at which the system booted, or None if unknown
+    try:
+        with open("/proc/stat") as f:
+            for line in f:
+                if line.startswith("btime "):
+                    return float(line.split()[1])
+    except IOError:
+        pass
+    # { sec = 1700000000, usec = 0 } Tue Nov 14 22:13:20 2023
+    match = re.search(r'sec = (\d+)', executeCommand("sysctl -n kern.boottime", "", True) or "")
+    return float(match.group(1)) if match else None
+
+def getBoolean (value):
+    if isinstance(value, bool):
+        return value
+    return value.strip().lower() in ['1', 'yes', 'true', 'on']
+
+def getNames (value):
+    return tuple(value.replace(',', ' ').split())
+
+def getCredentials (value):
+    # NAME=provider:reference, separated by commas or spaces
+    credentials = []
+    for item in value.replace(',', ' ').split():
+        name, equals, spec = item.partition('=')
+        provider, colon, reference = spec.partition(':')
+        if not name or not equals or not colon:
+            logger.error("Ignoring CREDENTIALS entry " + item + ". Expected NAME=provider:reference")
+            continue
+        credentials.append((name, provider, reference))
+    return tuple(credentials)
+
+def getOutputMode (value):
+    mode = value.strip().lower()
+    if mode not in OUTPUT_MODES:
+        logger.error("Unknown OUTPUT_MODE " + value + ". Using " + DEFAULT_OUTPUT_MODE)
+        return DEFAULT_OUTPUT_MODE
+    return mode
+
+def getHookMode (value):
+    mode = value.strip().lower()
+    if mode not in HOOK_MODES:
+        logger.error("Unknown HOOK_MODE " + value + ". Using " + DEFAULT_HOOK_MODE)
+        return DEFAULT_HOOK_MODE
+    return mode
+
+def getPorts (value):
+    return tuple(int(port) for port in value.replace(',', ' ').split())
+
 # int main(int argc, char *argv[]);
 def crux ():
     global conffile
     global confdir
+    global mounterScheduler
+    global configWatcher
+    global monitorWakeup
+    global commandExecutor
+    global stateStore
+    global historyStore
+    global traceWriter
+    global profileFile
+    global mountSlots
+    global credentialCache
 
     parser = setupParser()
     args = parser.parse_args()
@@ -338,10 +1117,44 @@ def crux ():
         args.logfile = os.path.join(os.path.expanduser("~"), "Library/Application Support/macmounter/macmounter.log")
 
     args.logfile = get_absolute_path(args.logfile)
-    setupLogger (logger, args.loglevel, args.logfile, not args.nostdout, False, True, 10)
+    setupLogger (logger, args.loglevel, args.logfile, not args.nostdout, False, True, 10,
+                 logformat=args.logformat, repeatSeconds=args.logrepeat, asynchronous=not args.logsync)
     logger.info("===> Starting macmounter on " + time.strftime("%Y-%m-%dT%H.%M.%S") + "with pid " + str(os.getpid()) + "<===")
 
+    commandExecutor = executor(args.maxchildren)
+    if args.mountconcurrency > 0:
+        mountSlots = threading.BoundedSemaphore(args.mountconcurrency)
+    credentialCache = credentialcache(args.credentialsttl, get_absolute_path(args.credentialsfile), get_absolute_path(args.credentialskey))
+    for plugin in args.hookplugin:
+        hookDispatcher.loadPlugin(get_absolute_path(plugin))
+    controlsocket = None if args.controlsocket == 'none' else get_absolute_path(args.controlsocket)
+
+    if args.ctl:
+        request = {'command': args.ctl, 'section': args.section, 'file': get_absolute_path(args.file)}
+        try:
+            print json.dumps(sendControlCommand(controlsocket, request), indent=2, sort_keys=True)
+        except (socket.error, ValueError) as e:
+            logger.error("Could not talk to macmounter on " + str(controlsocket) + ": " + str(e))
+            sys.exit(1)
+        return
+
+    if args.history:
+        try:
+            report = historystore(get_absolute_path(args.historyfile)).query(args.since, args.section, get_absolute_path(args.file), args.by)
+        except sqlite3.Error as e:
+            logger.error("Could not read history file " + str(args.historyfile) + ": " + str(e))
+            sys.exit(1)
+        print json.dumps(report, indent=2, sort_keys=True)
+        return
+
     if args.reload:
+        if controlsocket and os.path.exists(controlsocket):
+            try:
+                reply = sendControlCommand(controlsocket, {'command': 'reload'})
+                logger.info("Reloaded " + str(len(reply.get('sections', []))) + " sections.")
+                return
+            except (socket.error, ValueError) as e:
+                logger.info("Could not reload over " + controlsocket + ": " + str(e) + ". Falling back to SIGHUP.")
         # BSD Specific?
         cmd = "launchctl list | grep com.irouble.macmounter | cut -f1"
         pid = executeCommand(cmd, "", True)
@@ -350,39 +1163,75 @@ def crux ():
             os.kill(int(pid), signal.SIGHUP)
         return
 
+    if args.engine == 'scheduler':
+        logger.info("Using scheduler engine with " + str(args.workers) + " workers")
+        mounterScheduler = scheduler(args.workers)
+        mounterScheduler.start()
+
+    monitorWakeup = selfpipe()
+    configWatcher = setupConfigWatcher(args.watcher)
+    if args.metricsport:
+        setupMetricsServer(args.metricsaddress, args.metricsport)
+    controlServer = None
+    if controlsocket:
+        controlServer = setupControlServer(controlsocket)
+    makeRuntimeFolder()
+    if args.statefile != 'none':
+        stateStore = statestore(get_absolute_path(args.statefile))
+        stateStore.start()
+    if args.historyfile != 'none':
+        historyStore = historystore(get_absolute_path(args.historyfile), args.historyrows)
+        historyStore.start()
+    if args.tracefile:
+        traceWriter = tracer(get_absolute_path(args.tracefile), args.traceevents)
+        traceWriter.start()
+    profileFile = get_absolute_path(args.profilefile)
     launchMounters(updateConfig())
-    monitorConfigs()
-    waitOnMounters()
+    setupNetworkMonitor(args.netmonitor, args.netdebounce, args.netmingap)
+    if configWatcher:
+        watchConfigs(configWatcher)
+    else:
+        monitorConfigs()
+    waitOnMounters(args.shutdowntimeout)
+    if controlServer:
+        controlServer.close()
+        try:
+            os.unlink(controlsocket)
+        except OSError:
+            pass
+
+def executeCommand(cmd, logPrefix="", returnstdout=False, timeout=None, kind=None, env=None):
+    rc, streamdata = captureCommand(cmd, logPrefix, timeout, kind, env)
+    if returnstdout:
+        return streamdata
+    else:
+        return rc
 
-def executeCommand(cmd, logPrefix="", returnstdout=False):
+# Returns (rc, output). Only the last capture bytes of output are kept (all
+# of it if capture is None), and outputmode 'log' also logs it line by line.
+def captureCommand(cmd, logPrefix="", timeout=None, kind=None, env=None, capture=None, outputmode=DEFAULT_OUTPUT_MODE):
     rc = None
-    #args = shlex.split(cmd) 
+    streamdata = None
     args = cmd
-    logger.info(logPrefix + "Running cmd: " + str(args))
+    logger.info("%sRunning cmd: %s", logPrefix, args)
     try:
-        child = subprocess.Popen(args, stderr=subprocess.STDOUT, stdout=subprocess.PIPE, shell=True)
-        streamdata = child.communicate()[0]
-        child.wait()
-        rc = child.returncode
-        #print "SD: " + streamdata
-        #print "here RC"
+        rc, streamdata = commandExecutor.execute(args, logPrefix, timeout, kind, env, capture, outputmode)
     except CalledProcessError as e:
-        #print "here2 RC"
         rc = e.returncode
     except OSError as ose:
-        #print "here3 RC"
         rc = ose.errno
     except:
-        #print "here4 RC"
         print traceback.format_exc()
         print sys.exc_info()[0]
     finally:
-        #print "here5 RC"
-        logger.info(logPrefix + "RC=" + str(rc))
-        if returnstdout:
-            return streamdata
-        else:
-            return rc
+        return rc, cleanOutput(streamdata)
+
+# Commands may print anything. Their output ends up in JSON (status, hook
+# events, JSON logs), so replace whatever is not valid UTF-8.
+def cleanOutput (data):
+    if data is None:
+        return None
+    return data.decode('utf-8', 'replace').encode('utf-8')
 
 def isBlank (myString):
     if myString and myString.strip():
@@ -398,220 +1247,2398 @@ def isNotBlank (myString):
     #myString is None OR myString is empty or blank
     return False
 
-def runCmd (cmd, logPrefix=""):
-    if cmd and (executeCommand(cmd, logPrefix) == 0):
+def runCmd (cmd, logPrefix="", timeout=None, kind=None, env=None):
+    if cmd and (executeCommand(cmd, logPrefix, False, timeout, kind, env) == 0):
         return True
     else:
         return False
 
-class mounter (threading.Thread):
+class selfpipe (object):
+    """A wakeup flag backed by a pipe, so waiters block in select() instead of polling."""
+    def __init__ (self):
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno (self):
+        return self.rfd
+
+    def set (self):
+        try:
+            os.write(self.wfd, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def clear (self):
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait (self, timeout=None):
+        ready = selfpipe.poll(self.rfd, timeout)
+        self.clear()
+        return ready
+
+    @staticmethod
+    def poll (fd, timeout=None):
+        # select() on a single fd, treating EINTR as a timeout
+        try:
+            return bool(select.select([fd], [], [], timeout)[0])
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+
+class inotifywatcher (object):
+    """Watches config files and directories with inotify (Linux only).
+    read() returns the config files that were changed, added or removed.
+    A root (config file or directory) is watched itself while it exists, and
+    its parent (likely $HOME) only while it does not, so that nothing else
+    written next to it wakes us up."""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    # A file is replaced (renamed over, as editors do) when its link count
+    # drops (IN_ATTRIB) and it goes away (IN_DELETE_SELF)
+    FILE_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+    SELF_EVENTS = IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT = struct.Struct('iIII')
+
+    def __init__ (self, roots):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.roots = roots
+        self.watches = dict() # wd => watched path
+        self.paths = dict() # watched path => wd
+        self.parents = set() # parents watched for a missing root
+        self.sync()
+
+    def fileno (self):
+        return self.fd
+
+    def close (self):
+        os.close(self.fd)
+
+    def addWatch (self, path, mask=MASK):
+        if path in self.paths:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            logger.error("Could not watch " + path + ": " + os.strerror(ctypes.get_errno()))
+            return
+        logger.info("Watching " + path)
+        self.watches[wd] = path
+        self.paths[path] = wd
+
+    def removeWatch (self, path):
+        wd = self.paths.pop(path, None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            # Fails harmlessly if the kernel already dropped it
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def sync (self):
+        # Watches every root that exists, and the parents of those that don't.
+        # Returns the config files that are newly watched.
+        added = []
+        parents = set()
+        for path, isdir in self.roots:
+            if isdir and os.path.isdir(path):
+                self.addTree(path)
+            elif not isdir and os.path.isfile(path):
+                if path not in self.paths:
+                    self.addWatch(path, self.FILE_MASK)
+                    added.append(path)
+            else:
+                parents.add(os.path.dirname(path))
+        for parent in parents:
+            self.addWatch(parent)
+        for parent in self.parents - parents:
+            if not self.inTree(parent):
+                self.removeWatch(parent)
+        self.parents = parents
+        return added
+
+    def addTree (self, directory):
+        for dirname, subdirs, files in os.walk(directory):
+            self.addWatch(dirname)
+
+    def isRoot (self, path, isdir):
+        return (path, isdir) in self.roots
+
+    def inTree (self, path):
+        for root, isdir in self.roots:
+            if isdir and (path == root or path.startswith(root + os.sep)):
+                return True
+        return False
+
+    def rescan (self):
+        configFiles = []
+        for path, isdir in self.roots:
+            if isdir:
+                configFiles.extend(getConfFilesFromFolder(path))
+            elif os.path.isfile(path):
+                configFiles.append(path)
+        return configFiles
+
+    def read (self):
+        configFiles = []
+        resync = False
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return configFiles
+            raise
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip('\0')
+            offset += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                logger.info("inotify queue overflowed, rescanning configs.")
+                configFiles.extend(self.rescan())
+                continue
+            if mask & self.IN_IGNORED:
+                path = self.watches.pop(wd, None)
+                if self.paths.get(path) == wd:
+                    del self.paths[path]
+                continue
+            if wd not in self.watches:
+                continue
+            if not name:
+                # An event on a watched root itself
+                path = self.watches[wd]
+                if self.isRoot(path, False):
+                    configFiles.append(path)
+                    if mask & self.SELF_EVENTS:
+                        # Replaced or gone. Watch whatever is there now.
+                        self.removeWatch(path)
+                        resync = True
+                elif self.isRoot(path, True) and mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    for record in mounterMap.values():
+                        if record.filename.startswith(path + os.sep):
+                            configFiles.append(record.filename)
+                    for watched in self.paths.keys():
+                        if watched == path or watched.startswith(path + os.sep):
+                            self.removeWatch(watched)
+                    resync = True
+                continue
+            path = os.path.join(self.watches[wd], name)
+            if self.isRoot(path, True) or self.isRoot(path, False):
+                resync = True
+            if mask & self.IN_ISDIR:
+                if not (self.isRoot(path, True) or self.inTree(path)):
+                    continue
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.addTree(path)
+                    configFiles.extend(getConfFilesFromFolder(path))
+                else:
+                    # Directory went away, so did every config below it
+                    for record in mounterMap.values():
+                        if record.filename.startswith(path + os.sep):
+                            configFiles.append(record.filename)
+            elif self.isRoot(path, False) or (name.endswith(".conf") and self.inTree(path)):
+                if mask & self.IN_CREATE:
+                    # Wait for the IN_CLOSE_WRITE
+                    continue
+                configFiles.append(path)
+        if resync:
+            # What was written before the new watch was added is not seen
+            configFiles.extend(self.sync())
+        return configFiles
+
+class mounttable (object):
+    """The system mount table, indexed by mount point. It is read at most once
+    per scheduler tick (or MOUNT_TABLE_TTL_SECONDS) and shared by all sections."""
+    MOUNTINFO_ESCAPE = re.compile(r'\\([0-7]{3})')
+    MOUNT_LINE = re.compile(r'^(.*) on (.*) \(([^,)]+)')
+
+    def __init__ (self, ttl=MOUNT_TABLE_TTL_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = dict() # mount point => (source, fstype)
+        self.stamp = None
+
+    def invalidate (self):
+        self.stamp = None
+
+    def get (self):
+        with self.lock:
+            now = time.time()
+            if self.stamp is None or now - self.stamp >= self.ttl:
+                self.entries = self.read()
+                self.stamp = now
+            return self.entries
+
+    def isMounted (self, mountpoint, fstype=None, source=None):
+        entry = self.get().get(os.path.normpath(mountpoint))
+        if entry is None:
+            return False
+        if isNotBlank(fstype) and entry[1] != fstype:
+            logger.info("Mount point " + mountpoint + " has fstype " + entry[1] + ", expected " + fstype)
+            return False
+        if isNotBlank(source) and entry[0] != source:
+            logger.info("Mount point " + mountpoint + " has source " + entry[0] + ", expected " + source)
+            return False
+        return True
+
+    def unescape (self, field):
+        return self.MOUNTINFO_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+    def read (self):
+        if os.path.isfile(MOUNTINFO_FILE):
+            return self.readMountInfo()
+        return self.readMountCmd()
+
+    def readMountInfo (self):
+        entries = dict()
+        with open(MOUNTINFO_FILE) as f:
+            for line in f:
+                # id parent major:minor root mountpoint options [optional...] - fstype source superoptions
+                fields = line.split()
+                try:
+                    separator = fields.index('-', 6)
+                    mountpoint = self.unescape(fields[4])
+                    entries[mountpoint] = (self.unescape(fields[separator + 2]), fields[separator + 1])
+                except (ValueError, IndexError):
+                    continue
+        return entries
+
+    def readMountCmd (self):
+        entries = dict()
+        output = executeCommand(MOUNT_TABLE_CMD, "", True) or ""
+        for line in output.splitlines():
+            # //user@host/share on /Volumes/share (smbfs, nodev, nosuid, mounted by user)
+            match = self.MOUNT_LINE.match(line)
+            if match:
+                entries[match.group(2)] = (match.group(1), match.group(3).strip())
+        return entries
+
+class probe (object):
+    """One in-flight reachability probe of a host, shared by everyone asking."""
+    __slots__ = ('key', 'host', 'ports', 'timeout', 'icmp', 'addresses', 'deadline', 'sockets', 'result', 'done')
+
+    def __init__ (self, key, host, ports, timeout, icmp):
+        self.key = key
+        self.host = host
+        self.ports = ports
+        self.timeout = timeout
+        self.icmp = icmp
+        self.addresses = []
+        self.deadline = None
+        self.sockets = []
+        self.result = False
+        self.done = threading.Event()
+
+    def wait (self):
+        # The prober finishes every probe by its deadline, this is in case it can't
+        self.done.wait(self.timeout + PROBE_WAIT_MARGIN_SECONDS)
+        return self.result
+
+class prober (threading.Thread):
+    """Checks reachability without spawning processes. Every probe opens
+    non-blocking TCP connects to the given ports (a refused connection still
+    means the host is up), plus an ICMP echo if asked for and allowed, and all
+    probes are multiplexed over one select() loop with per-probe deadlines.
+    A probe with nothing it is allowed to send results in None, not False."""
+    ICMP_ECHO_REQUEST = 8
+    ICMP_ECHO_REPLY = 0
+
+    def __init__ (self):
+        threading.Thread.__init__(self, name="prober")
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.wakeup = selfpipe()
+        self.inflight = dict() # key => probe
+        self.pending = []
+        self.sockets = dict() # fd => (probe, socket, isicmp)
+        self.icmpAllowed = True
+
+    def probe (self, host, ports=(), timeout=DEFAULT_PING_TIMEOUT, icmp=False):
+        return self.submit(host, ports, timeout, icmp).wait()
+
+    def submit (self, host, ports=(), timeout=DEFAULT_PING_TIMEOUT, icmp=False):
+        key = (host, tuple(ports or ()), bool(icmp))
+        with self.lock:
+            if not self.isAlive():
+                self.start()
+            if key in self.inflight:
+                return self.inflight[key]
+            p = probe(key, host, key[1], timeout, icmp)
+            self.inflight[key] = p
+        try:
+            # Resolve in the caller's thread, so a slow resolver only holds up
+            # this host and not every probe in flight
+            p.addresses = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+        except socket.error as e:
+            logger.info("Could not resolve " + host + ": " + str(e))
+            self.finish(p, False)
+            return p
+        with self.lock:
+            self.pending.append(p)
+        self.wakeup.set()
+        return p
+
+    def finish (self, p, result):
+        for sock in p.sockets:
+            self.sockets.pop(sock.fileno(), None)
+            sock.close()
+        p.sockets = []
+        p.result = result
+        with self.lock:
+            if self.inflight.get(p.key) is p:
+                del self.inflight[p.key]
+        p.done.set()
+
+    def begin (self, p):
+        p.deadline = time.time() + p.timeout
+        for family, socktype, proto, canonname, sockaddr in p.addresses:
+            for port in p.ports:
+                try:
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                except socket.error as e:
+                    # Out of descriptors, or no such address family here
+                    logger.info("Could not probe " + p.host + " at " + sockaddr[0] + " port " + str(port) + ": " + str(e))
+                    continue
+                sock.setblocking(0)
+                rc = sock.connect_ex((sockaddr[0], port) + tuple(sockaddr[2:]))
+                if rc in (0, errno.ECONNREFUSED):
+                    sock.close()
+                    self.finish(p, True)
+                    return
+                if rc not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sock.close()
+                    continue
+                p.sockets.append(sock)
+                self.sockets[sock.fileno()] = (p, sock, False)
+            if p.icmp and family == socket.AF_INET:
+                self.sendEcho(p, sockaddr[0])
+        if not p.sockets:
+            # No ports, and no ICMP either, says nothing about the host
+            self.finish(p, False if p.ports or (p.icmp and self.icmpAllowed) else None)
+
+    def sendEcho (self, p, address):
+        if not self.icmpAllowed:
+            return
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.getprotobyname('icmp'))
+        except socket.error as e:
+            if e.errno in (errno.EPERM, errno.EACCES, errno.EPROTONOSUPPORT):
+                logger.info("ICMP probes are not permitted here, only using TCP probes.")
+                self.icmpAllowed = False
+                return
+            logger.info("Could not send an ICMP echo to " + address + ": " + str(e))
+            return
+        sock.setblocking(0)
+        payload = 'macmounter'
+        header = struct.pack('!BBHHH', self.ICMP_ECHO_REQUEST, 0, 0, 0, 1)
+        header = struct.pack('!BBHHH', self.ICMP_ECHO_REQUEST, 0, self.checksum(header + payload), 0, 1)
+        try:
+            sock.sendto(header + payload, (address, 0))
+        except socket.error:
+            sock.close()
+            return
+        p.sockets.append(sock)
+        self.sockets[sock.fileno()] = (p, sock, True)
+
+    def checksum (self, data):
+        if len(data) % 2:
+            data += '\0'
+        total = sum(struct.unpack('!%dH' % (len(data) / 2), data))
+        total = (total >> 16) + (total & 0xffff)
+        total += total >> 16
+        return ~total & 0xffff
+
+    def run (self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                # Nobody may be left waiting on a probe this thread dropped
+                logger.exception("Prober failed. Failing the probes in flight.")
+                self.abandon()
+
+    def poll (self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        for p in pending:
+            self.begin(p)
+        readers = [self.wakeup.fileno()]
+        writers = []
+        for fd, (p, sock, isicmp) in self.sockets.items():
+            (readers if isicmp else writers).append(fd)
+        deadlines = set(p for p, sock, isicmp in self.sockets.values())
+        timeout = None
+        if deadlines:
+            timeout = max(0, min(p.deadline for p in deadlines) - time.time())
+        try:
+            readable, writable = select.select(readers, writers, [], timeout)[:2]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if self.wakeup.fileno() in readable:
+            self.wakeup.clear()
+        for fd in writable:
+            if fd not in self.sockets:
+                continue
+            p, sock, isicmp = self.sockets[fd]
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err in (0, errno.ECONNREFUSED):
+                self.finish(p, True)
+            else:
+                self.drop(p, fd, sock)
+        for fd in readable:
+            if fd not in self.sockets:
+                continue
+            p, sock, isicmp = self.sockets[fd]
+            try:
+                data = sock.recv(1024)
+            except socket.error:
+                self.drop(p, fd, sock)
+                continue
+            # Linux hands us the ICMP message, BSD prepends the IP header
+            if len(data) >= 20 and ord(data[0]) >> 4 == 4:
+                data = data[(ord(data[0]) & 0x0f) * 4:]
+            if data and ord(data[0]) == self.ICMP_ECHO_REPLY:
+                self.finish(p, True)
+        now = time.time()
+        for p in deadlines:
+            if p.sockets and p.deadline <= now:
+                self.finish(p, False)
+
+    def abandon (self):
+        with self.lock:
+            inflight = self.inflight.values()
+            self.pending = []
+        for p in inflight:
+            self.finish(p, False)
+        for fd, (p, sock, isicmp) in self.sockets.items():
+            sock.close()
+        self.sockets.clear()
+
+    def drop (self, p, fd, sock):
+        self.sockets.pop(fd, None)
+        p.sockets.remove(sock)
+        sock.close()
+        if not p.sockets:
+            self.finish(p, False)
+
+class reachability (object):
+    """Per-host single-flight cache of reachability results. While one section
+    is pinging (and waking) a host, every other section asking about the same
+    host waits for that result instead of pinging it again, and the result is
+    reused until it is ttl seconds old."""
+    class entry (object):
+        __slots__ = ('result', 'expires', 'done', 'waiters')
+
+        def __init__ (self):
+            self.result = False
+            self.expires = 0
+            self.done = threading.Event()
+            self.waiters = []
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.entries = dict()
+
+    def check (self, key, ttl, fn, logPrefix=""):
+        with self.lock:
+            e = self.entries.get(key)
+            if e is not None and e.done.isSet() and e.expires <= time.time():
+                e = None
+            owner = e is None
+            if owner:
+                e = reachability.entry()
+                self.entries[key] = e
+        if not owner:
+            e.done.wait()
+            logger.info("%sUsing shared ping result: %s", logPrefix, e.result)
+            return e.result
+        try:
+            e.result = fn()
+        finally:
+            e.expires = time.time() + ttl
+            with self.lock:
+                e.done.set()
+                waiters, e.waiters = e.waiters, []
+            for callback in waiters:
+                callback()
+        return e.result
+
+    def park (self, key, callback):
+        # Instead of waiting in check(), has callback called once the ping in
+        # flight for key is done. Returns False if there is none in flight.
+        with self.lock:
+            e = self.entries.get(key)
+            if e is None or e.done.isSet():
+                return False
+            e.waiters.append(callback)
+            return True
+
+    def clear (self):
+        with self.lock:
+            for key, e in self.entries.items():
+                if e.done.isSet():
+                    del self.entries[key]
+
+class executor (object):
+    """Runs commands for all sections. Each child gets its own process group,
+    at most maxChildren run at once, and a child that outlives its timeout is
+    killed along with everything it started. Per kind counts and durations
+    are kept in stats."""
+    def __init__ (self, maxChildren=DEFAULT_MAX_CHILDREN):
+        self.slots = threading.BoundedSemaphore(max(1, maxChildren))
+        self.lock = threading.Lock()
+        self.children = dict() # pid => Popen
+        self.stats = dict() # kind => [count, failures, timeouts, seconds]
+        self.argvs = dict() # cmd => argv, or None if it needs a shell
+        self.orphans = [] # killed children that have not exited yet
+        self.closed = False
+
+    def getArgv (self, cmd):
+        # Simple commands are exec'ed directly, which saves spawning /bin/sh
+        # on top of the actual command. Anything the shell would expand,
+        # redirect or chain still goes through the shell.
+        if cmd not in self.argvs:
+            argv = None
+            if not SHELL_METACHARACTERS.search(cmd):
+                try:
+                    argv = shlex.split(cmd)
+                except ValueError:
+                    argv = None
+                if not argv or '=' in argv[0] or argv[0] in SHELL_BUILTINS:
+                    argv = None
+            self.argvs[cmd] = argv
+        return self.argvs[cmd]
+
+    def spawn (self, cmd, argv, env):
+        return subprocess.Popen(argv or cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE, shell=argv is None,
+                                close_fds=True, preexec_fn=os.setsid, env=env)
+
+    def execute (self, cmd, logPrefix="", timeout=None, kind=None, env=None, capture=None, outputmode=DEFAULT_OUTPUT_MODE):
+        # Returns (rc, output). rc is None if the command timed out. A
+        # timeout of 0 (or less) waits forever.
+        if timeout is not None and timeout <= 0:
+            timeout = None
+        if self.closed:
+            logger.info("%sShutting down. Not running command.", logPrefix)
+            return None, ''
+        argv = self.getArgv(cmd)
+        self.reapOrphans()
+        if env:
+            env = dict(os.environ, **env)
+        self.slots.acquire()
+        try:
+            start = time.time()
+            try:
+                child = self.spawn(cmd, argv, env)
+            except OSError as e:
+                if argv is None:
+                    raise
+                # Not a program. The shell may still know it (a builtin we
+                # do not list, a function), or says "command not found".
+                logger.info("%sCould not run %s directly: %s. Running it through the shell.", logPrefix, argv[0], e.strerror)
+                self.argvs[cmd] = None
+                child = self.spawn(cmd, None, env)
+            with self.lock:
+                self.children[child.pid] = child
+            if outputmode == 'discard':
+                capture = 0
+            try:
+                output, timedout = self.collect(child, timeout, outputbuffer(capture), logPrefix if outputmode == 'log' else None)
+            finally:
+                with self.lock:
+                    self.children.pop(child.pid, None)
+        finally:
+            self.slots.release()
+        duration = time.time() - start
+        if timedout:
+            rc = None
+            outcome = 'timeout'
+            logger.error("%sCommand timed out after %s seconds. Killed its process group.", logPrefix, timeout)
+        else:
+            rc = child.returncode
+            outcome = 'ok' if rc == 0 else 'failed'
+        logger.info("%sRC=%s (%s in %.3fs)", logPrefix, rc, outcome, duration, extra={'kind': kind, 'duration': duration})
+        self.record(kind, outcome, duration)
+        return rc, output
+
+    def collect (self, child, timeout, output, logPrefix=None):
+        # Reads the child's output into the output buffer until it exits, or
+        # until timeout. Does not wait for EOF once the child is gone, since
+        # daemons (like sshfs) may keep the pipe open long after the command
+        # returned. With a logPrefix, output is also logged line by line.
+        deadline = None if timeout is None else time.time() + timeout
+        fd = child.stdout.fileno()
+        partial = ''
+        try:
+            while True:
+                wait = COMMAND_POLL_SECONDS
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        self.killGroup(child)
+                        self.waitOrOrphan(child)
+                        return output.getvalue(), True
+                if selfpipe.poll(fd, wait):
+                    data = os.read(fd, 65536)
+                    if not data:
+                        break
+                    output.write(data)
+                    if logPrefix is not None:
+                        lines = (partial + data).split('\n')
+                        partial = lines.pop()
+                        if len(partial) > DEFAULT_OUTPUT_CAPTURE_BYTES:
+                            lines.append(partial)
+                            partial = ''
+                        for line in lines:
+                            logger.info("%s> %s", logPrefix, cleanOutput(line))
+                elif child.poll() is not None:
+                    break
+        finally:
+            child.stdout.close()
+            if partial:
+                logger.info("%s> %s", logPrefix, cleanOutput(partial))
+        child.wait()
+        return output.getvalue(), False
+
+    def waitOrOrphan (self, child):
+        # A child stuck on a hung filesystem may not die even on SIGKILL. Leave
+        # it to be reaped later rather than blocking on it.
+        deadline = time.time() + KILL_GRACE_SECONDS
+        while child.poll() is None:
+            if time.time() >= deadline:
+                logger.error("Child %s did not exit after being killed. Will reap it later.", child.pid)
+                with self.lock:
+                    self.orphans.append(child)
+                return False
+            time.sleep(COMMAND_POLL_SECONDS / 5)
+        return True
+
+    def reapOrphans (self):
+        with self.lock:
+            self.orphans = [child for child in self.orphans if child.poll() is None]
+
+    def killGroup (self, child):
+        try:
+            os.killpg(child.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def close (self):
+        # No new commands from here on, and the running ones are killed
+        self.closed = True
+        self.killAll()
+
+    def killAll (self):
+        with self.lock:
+            children = self.children.values()
+        for child in children:
+            logger.info("Killing process group of child %s", child.pid)
+            self.killGroup(child)
+
+    def record (self, kind, outcome, duration):
+        with self.lock:
+            stats = self.stats.setdefault(kind or 'OTHER', [0, 0, 0, 0.0])
+            stats[0] += 1
+            if outcome == 'failed':
+                stats[1] += 1
+            elif outcome == 'timeout':
+                stats[2] += 1
+            stats[3] += duration
+
+class outputbuffer (object):
+    """Keeps the last limit bytes written to it (everything if limit is None)."""
+    def __init__ (self, limit=None):
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def write (self, data):
+        if self.limit == 0:
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.limit is not None and self.size > self.limit:
+            excess = self.size - self.limit
+            first = self.chunks[0]
+            if len(first) <= excess:
+                self.chunks.popleft()
+                self.size -= len(first)
+            else:
+                self.chunks[0] = first[excess:]
+                self.size -= excess
+
+    def getvalue (self):
+        return ''.join(self.chunks)
+
+class healthprober (object):
+    """Checks that a mounted filesystem still answers by listing it from a
+    child process. Only the child can hang on a dead server: it is killed at
+    the deadline, and no new probe of the same path is started while a killed
+    one is still stuck."""
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.hung = dict() # path => Popen of a killed probe that has not exited
+
+    def check (self, path, timeout, logPrefix=""):
+        # Returns True if path could be listed within timeout
+        with self.lock:
+            child = self.hung.get(path)
+            if child is not None:
+                if child.poll() is None:
+                    logger.info("%sPrevious probe of %s is still stuck.", logPrefix, path)
+                    return False
+                del self.hung[path]
+        start = time.time()
+        try:
+            child = subprocess.Popen(HEALTH_PROBE_ARGV + [path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     close_fds=True, preexec_fn=os.setsid)
+        except OSError as e:
+            # Can't probe. Don't unmount anything over it.
+            logger.error("%sCould not run health probe: %s", logPrefix, e.strerror)
+            return True
+        fd = child.stdout.fileno()
+        deadline = start + timeout
+        try:
+            while True:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    logger.error("%sHealth probe of %s timed out after %s seconds.", logPrefix, path, timeout)
+                    commandExecutor.killGroup(child)
+                    if not commandExecutor.waitOrOrphan(child):
+                        with self.lock:
+                            self.hung[path] = child
+                    commandExecutor.record('HEALTH_PROBE', 'timeout', time.time() - start)
+                    return False
+                # Output is thrown away, and EOF means the listing is done
+                if selfpipe.poll(fd, wait) and not os.read(fd, 65536):
+                    break
+        finally:
+            child.stdout.close()
+        child.wait()
+        healthy = child.returncode == 0
+        if not healthy:
+            logger.info("%sHealth probe of %s failed with RC=%s", logPrefix, path, child.returncode)
+        commandExecutor.record('HEALTH_PROBE', 'ok' if healthy else 'failed', time.time() - start)
+        return healthy
+
+class statestore (threading.Thread):
+    """Keeps a snapshot of every section's state in a JSON file, so that a
+    restarted daemon picks up where the last one left off. Saves are
+    coalesced and written from this thread through a temporary file."""
+    def __init__ (self, path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.lock = threading.Lock()
+        self.wakeup = selfpipe()
+        self.saved = dict() # key => what changed() compares, as last saved
+        self.restored = self.load()
+
+    def load (self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.error("Could not read state file %s: %s", self.path, e)
+            return dict()
+        except ValueError as e:
+            logger.error("Could not parse state file %s: %s", self.path, e)
+            return dict()
+        boottime = getBootTime()
+        if boottime and data.get('saved', 0) < boottime:
+            logger.info("State file %s was saved before the last boot. Ignoring it.", self.path)
+            return dict()
+        sections = data.get('sections', dict())
+        logger.info("Loaded state of %s sections from %s", len(sections), self.path)
+        return sections
+
+    def restore (self, record):
+        snapshot = self.restored.pop(record.statekey(), None)
+        if snapshot and snapshot.get('confighash') != record.optionshash:
+            logger.info("%sConfig changed since state was saved. Not restoring it.", record.logprefix)
+            return None
+        return snapshot
+
+    def changed (self, record):
+        # Only a change of state, mount or failure count triggers a save. Once
+        # shutting down, sections only fail because their commands are killed.
+        if running and self.saved.get(record.statekey()) != self.significant(record.snapshot()):
+            self.wakeup.set()
+
+    def significant (self, snapshot):
+        return (snapshot['state'], snapshot['mounted'], snapshot['failures'], snapshot['confighash'])
+
+    def save (self):
+        with self.lock:
+            sections = dict()
+            for record in mounterMap.values():
+                sections[record.statekey()] = record.snapshot()
+            tmpfile = self.path + ".tmp"
+            try:
+                with open(tmpfile, 'w') as f:
+                    json.dump({'saved': time.time(), 'sections': sections}, f, sort_keys=True)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmpfile, self.path)
+            except (IOError, OSError) as e:
+                logger.error("Could not save state file %s: %s", self.path, e)
+                return
+            self.saved = dict((key, self.significant(snapshot)) for key, snapshot in sections.items())
+
+    def run (self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(STATE_SAVE_DELAY_SECONDS)
+            self.wakeup.clear()
+            if running:
+                self.save()
+
+class queuewriter (threading.Thread):
+    """A background thread writing what is put on its queue to path, until it
+    gets None."""
+    def __init__ (self, path, size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.queue = Queue.Queue(size)
+
+    def close (self, timeout):
+        # The thread is gone if it could not open its file, and then nothing
+        # drains the queue
+        if not self.is_alive():
+            return
+        deadline = time.time() + timeout
+        try:
+            self.queue.put(None, True, timeout)
+        except Queue.Full:
+            return
+        self.join(max(0, deadline - time.time()))
+
+class historystore (queuewriter):
+    """Records every check in an SQLite file, keeping the last rows checks.
+    Checks only queue their record. This thread inserts them in batches, so a
+    slow disk never holds up a check."""
+    COLUMNS = ('time', 'section', 'file', 'host', 'fromstate', 'tostate', 'mounted', 'stale', 'duration',
+               'ping_duration', 'ping_rc', 'test_duration', 'test_rc', 'mount_duration', 'mount_rc')
+
+    def __init__ (self, path, rows=DEFAULT_HISTORY_ROWS):
+        queuewriter.__init__(self, path, HISTORY_QUEUE_SIZE)
+        self.rows = rows
+        self.dropped = 0
+
+    def connect (self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("CREATE TABLE IF NOT EXISTS checks (id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, section TEXT, file TEXT, host TEXT, "
+                           "fromstate TEXT, tostate TEXT, mounted INTEGER, duration REAL, ping_duration REAL, ping_rc INTEGER, "
+                           "test_duration REAL, test_rc INTEGER, mount_duration REAL, mount_rc INTEGER, stale INTEGER)")
+        if 'stale' not in [column[1] for column in connection.execute("PRAGMA table_info(checks)")]:
+            # History files from before stale mounts were told apart
+            connection.execute("ALTER TABLE checks ADD COLUMN stale INTEGER")
+        connection.execute("CREATE INDEX IF NOT EXISTS checks_time ON checks (time)")
+        connection.commit()
+        return connection
+
+    def record (self, record, start, fromstate, duration):
+        row = [start, record.section, record.filename, record.host, fromstate, record.state, int(record.mounted), int(record.steps.get('stale', False)), duration]
+        for step in ('ping', 'test', 'mount'):
+            row.extend(record.steps.get(step, (None, None)))
+        try:
+            self.queue.put_nowait(tuple(row))
+        except Queue.Full:
+            self.dropped += 1
+
+    def run (self):
+        try:
+            connection = self.connect()
+        except sqlite3.Error as e:
+            logger.error("Could not open history file %s: %s", self.path, e)
+            return
+        closing = False
+        while not closing:
+            batch = [self.queue.get()]
+            # Gather whatever else comes in the meantime into the same insert
+            daemonLifecycle.wait(HISTORY_FLUSH_SECONDS)
+            while len(batch) < HISTORY_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            closing = None in batch
+            self.write(connection, [row for row in batch if row is not None])
+        connection.close()
+
+    def write (self, connection, batch):
+        if self.dropped:
+            logger.error("History queue full. Dropped %s checks.", self.dropped)
+            self.dropped = 0
+        if not batch:
+            return
+        try:
+            with connection:
+                connection.executemany("INSERT INTO checks (" + ", ".join(self.COLUMNS) + ") VALUES (" + ", ".join("?" * len(self.COLUMNS)) + ")", batch)
+                connection.execute("DELETE FROM checks WHERE id <= (SELECT MAX(id) FROM checks) - ?", (self.rows,))
+        except sqlite3.Error as e:
+            logger.error("Could not write %s checks to history file %s: %s", len(batch), self.path, e)
+
+    def query (self, since, section=None, filename=None, by='section'):
+        # Flap rate, mount latency and availability of every section (or
+        # host) over the last since seconds
+        now = time.time()
+        sql = "SELECT " + ", ".join(self.COLUMNS) + " FROM checks WHERE time >= ?"
+        params = [now - since]
+        if section:
+            sql += " AND section = ?"
+            params.append(section)
+        if filename:
+            sql += " AND file = ?"
+            params.append(filename)
+        connection = self.connect()
+        try:
+            rows = [dict(zip(self.COLUMNS, row)) for row in connection.execute(sql + " ORDER BY time", params)]
+        finally:
+            connection.close()
+        bysection = collections.OrderedDict()
+        for row in rows:
+            bysection.setdefault(row['file'] + "[" + row['section'] + "]", []).append(row)
+        groups = collections.OrderedDict()
+        for key, checks in bysection.items():
+            group = key if by == 'section' else (checks[-1]['host'] or 'unknown')
+            stats = groups.setdefault(group, {'checks': 0, 'failures': 0, 'stale': 0, 'flaps': 0, 'observed': 0.0, 'mountedtime': 0.0, 'mounts': []})
+            for i, check in enumerate(checks):
+                # A check's outcome holds until the next check
+                until = checks[i + 1]['time'] if i + 1 < len(checks) else now
+                stats['checks'] += 1
+                stats['observed'] += until - check['time']
+                if check['mounted']:
+                    stats['mountedtime'] += until - check['time']
+                # A stale mount is a failure even if the same check remounted it
+                if check['stale']:
+                    stats['stale'] += 1
+                if check['stale'] or check['tostate'] in ['PING_FAILURE', 'MOUNT_FAILURE', 'MOUNT_STALE']:
+                    stats['failures'] += 1
+                # A flap is a mount that was lost, whether or not the same
+                # check got it back
+                if i > 0 and checks[i - 1]['mounted'] and (not check['mounted'] or check['mount_rc'] is not None):
+                    stats['flaps'] += 1
+                if check['mount_rc'] == 0 and check['mount_duration'] is not None:
+                    stats['mounts'].append(check['mount_duration'])
+        report = dict()
+        for group, stats in groups.items():
+            hours = stats['observed'] / 3600
+            report[group] = {'checks': stats['checks'], 'failures': stats['failures'], 'stale': stats['stale'], 'flaps': stats['flaps'],
+                             'flapsperhour': stats['flaps'] / hours if hours else None,
+                             'availability': stats['mountedtime'] / stats['observed'] if stats['observed'] else None,
+                             'mounts': len(stats['mounts']), 'mountp50': percentile(stats['mounts'], 50), 'mountp99': percentile(stats['mounts'], 99)}
+        return {'since': now - since, 'until': now, 'by': by, 'history': report}
+
+def percentile (values, p):
+    # Nearest rank
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+class tracer (queuewriter):
+    """Writes spans as Chrome trace events (a JSON array of complete events)
+    from a background thread. The file can be loaded in chrome://tracing or
+    Perfetto, also while the daemon is still writing it."""
+    def __init__ (self, path, limit=DEFAULT_TRACE_EVENTS):
+        queuewriter.__init__(self, path, TRACE_QUEUE_SIZE)
+        self.limit = limit
+        self.count = 0
+        self.pid = os.getpid()
+        self.threads = set()
+
+    def add (self, name, category, start, duration, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid, 'tid': thread.ident,
+                 'ts': int(start * 1000000), 'dur': int(duration * 1000000), 'args': args}
+        try:
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.queue.put_nowait({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': thread.ident, 'args': {'name': thread.name}})
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            pass
+
+    def run (self):
+        try:
+            f = open(self.path, 'w')
+        except IOError as e:
+            logger.error("Could not open trace file %s: %s", self.path, e)
+            return
+        with f:
+            f.write("[")
+            while True:
+                event = self.queue.get()
+                if event is None:
+                    break
+                if self.count >= self.limit:
+                    continue
+                f.write((",\n" if self.count else "\n") + json.dumps(event))
+                self.count += 1
+                if self.count == self.limit:
+                    logger.error("Wrote %s trace events to %s. Not tracing any more.", self.count, self.path)
+                if self.queue.empty():
+                    f.flush()
+            f.write("\n]\n")
+
+class tracespan (object):
+    """Times a with block, as a trace event, when tracing is on."""
+    __slots__ = ('name', 'category', 'args', 'start')
+
+    def __init__ (self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__ (self):
+        if traceWriter:
+            self.start = time.time()
+        return self
+
+    def __exit__ (self, *exc):
+        if traceWriter and self.start is not None:
+            traceWriter.add(self.name, self.category, self.start, time.time() - self.start, self.args)
+        return False
+
+class sampler (threading.Thread):
+    """Samples the stacks of every thread every PROFILE_SAMPLE_SECONDS, and
+    writes them as folded stacks (one 'thread;frame;frame count' line per
+    stack), the input of flamegraph.pl and speedscope."""
+    def __init__ (self):
+        threading.Thread.__init__(self, name="profiler")
+        self.daemon = True
+        self.stopping = threading.Event()
+        self.stacks = collections.defaultdict(int)
+        self.samples = 0
+
+    def run (self):
+        while not self.stopping.wait(PROFILE_SAMPLE_SECONDS):
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop (self):
+        self.stopping.set()
+        self.join()
+
+    def dump (self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write("%s %s\n" % (stack, count))
+
+class circuitbreaker (object):
+    """Per-host circuit breaker for MOUNT_CMD. After threshold consecutive
+    mount failures against a host, no section mounts from that host for
+    cooldown seconds. Then a single trial mount is let through (half open):
+    if it succeeds the breaker closes, if it fails the breaker opens again."""
+    CLOSED = 'CLOSED'
+    OPEN = 'OPEN'
+    HALF_OPEN = 'HALF_OPEN'
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.hosts = dict() # host => [state, consecutive failures, time of last state change]
+
+    def allow (self, host, threshold, cooldown):
+        if host is None or not threshold:
+            return True
+        with self.lock:
+            breaker = self.hosts.setdefault(host, [self.CLOSED, 0, 0])
+            if breaker[0] == self.CLOSED:
+                return True
+            # While open, and while a half open trial is in flight
+            if time.time() - breaker[2] < cooldown:
+                return False
+            logger.info("Circuit breaker for host " + host + " is half open. Letting one mount through.")
+            breaker[0] = self.HALF_OPEN
+            breaker[2] = time.time()
+            return True
+
+    def success (self, host):
+        if host is None:
+            return
+        with self.lock:
+            breaker = self.hosts.get(host)
+            if breaker is None:
+                return
+            if breaker[0] != self.CLOSED:
+                logger.info("Circuit breaker for host " + host + " closed.")
+            self.hosts[host] = [self.CLOSED, 0, time.time()]
+
+    def failure (self, host, threshold):
+        if host is None or not threshold:
+            return
+        with self.lock:
+            breaker = self.hosts.setdefault(host, [self.CLOSED, 0, 0])
+            breaker[1] += 1
+            if breaker[0] == self.HALF_OPEN or breaker[1] >= threshold:
+                if breaker[0] != self.OPEN:
+                    logger.info("Circuit breaker for host " + host + " opened after " + str(breaker[1]) + " failures.")
+                breaker[0] = self.OPEN
+                breaker[2] = time.time()
+
+class rtnetlinksource (object):
+    """Network change events from the kernel's rtnetlink socket (Linux only).
+    The kernel repeats address and route messages whenever it refreshes one
+    (every IPv6 router advertisement does), and sends link messages for
+    wireless events, so only new or removed addresses and routes and links
+    going up or down count. A route event carries the network it is for."""
+    NETLINK_ROUTE = 0
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    RTMGRP_IPV6_IFADDR = 0x100
+    RTMGRP_IPV6_ROUTE = 0x400
+    RTM_NEWLINK = 16
+    RTM_DELLINK = 17
+    RTM_NEWADDR = 20
+    RTM_DELADDR = 21
+    RTM_NEWROUTE = 24
+    RTM_DELROUTE = 25
+    RTA_DST = 1
+    IFA_ADDRESS = 1
+    IFA_LOCAL = 2
+    # What tells routes apart: dst, oif, gateway, priority, table
+    ROUTE_KEYS = (1, 4, 5, 6, 15)
+    RTM_F_CLONED = 0x200
+    LINK_FLAGS = 0x1 | 0x40 | 0x10000 # IFF_UP, IFF_RUNNING, IFF_LOWER_UP
+    NLMSGHDR = struct.Struct('=IHHII')
+    IFINFOMSG = struct.Struct('=BxHiII') # family, type, index, flags, change
+    IFADDRMSG = struct.Struct('=BBBBI') # family, prefixlen, flags, scope, index
+    RTMSG = struct.Struct('=BBBBBBBBI') # family, dst_len, src_len, tos, table, protocol, scope, type, flags
+    RTATTR = struct.Struct('=HH')
+
+    def __init__ (self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self.NETLINK_ROUTE)
+        self.sock.setblocking(0)
+        self.sock.bind((0, self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR | self.RTMGRP_IPV4_ROUTE |
+                           self.RTMGRP_IPV6_IFADDR | self.RTMGRP_IPV6_ROUTE))
+        self.links = dict() # index => up and running flags
+        self.addresses = set()
+        self.routes = set()
+
+    def fileno (self):
+        return self.sock.fileno()
+
+    def read (self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno == errno.ENOBUFS:
+                # We missed some events, which is a change all the same
+                return [('overflow', None)]
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        return self.parse(data)
+
+    def parse (self, data):
+        events = []
+        offset = 0
+        while offset + self.NLMSGHDR.size <= len(data):
+            length, msgtype = self.NLMSGHDR.unpack_from(data, offset)[:2]
+            if length < self.NLMSGHDR.size:
+                break
+            body = offset + self.NLMSGHDR.size
+            end = min(len(data), offset + length)
+            try:
+                event = self.event(msgtype, data, body, end)
+            except struct.error:
+                event = None
+            if event:
+                events.append(event)
+            offset += (length + 3) & ~3
+        return events
+
+    def event (self, msgtype, data, offset, end):
+        if msgtype in (self.RTM_NEWLINK, self.RTM_DELLINK):
+            family, linktype, index, flags, change = self.IFINFOMSG.unpack_from(data, offset)
+            state = flags & self.LINK_FLAGS if msgtype == self.RTM_NEWLINK else None
+            known = index in self.links
+            if self.links.get(index) == state or (not known and not change & self.LINK_FLAGS):
+                self.links[index] = state
+                return None
+            self.links[index] = state
+            return ('link', None)
+        if msgtype in (self.RTM_NEWADDR, self.RTM_DELADDR):
+            family, prefixlen, flags, scope, index = self.IFADDRMSG.unpack_from(data, offset)
+            attributes = self.attributes(data, offset + self.IFADDRMSG.size, end)
+            key = (family, prefixlen, index, attributes.get(self.IFA_ADDRESS), attributes.get(self.IFA_LOCAL))
+            if not self.changed(self.addresses, key, msgtype == self.RTM_NEWADDR):
+                return None
+            return ('address', None)
+        if msgtype in (self.RTM_NEWROUTE, self.RTM_DELROUTE):
+            header = self.RTMSG.unpack_from(data, offset)
+            if header[8] & self.RTM_F_CLONED:
+                return None
+            attributes = self.attributes(data, offset + self.RTMSG.size, end)
+            key = (header[:5],) + tuple(attributes.get(kind) for kind in self.ROUTE_KEYS)
+            if not self.changed(self.routes, key, msgtype == self.RTM_NEWROUTE):
+                return None
+            family, prefixlen = header[0], header[1]
+            return ('route', (family, attributes.get(self.RTA_DST, ''), prefixlen))
+        return None
+
+    def changed (self, known, key, added):
+        if added:
+            if key in known:
+                return False
+            known.add(key)
+            return True
+        known.discard(key)
+        return True
+
+    def attributes (self, data, offset, end):
+        attributes = dict()
+        while offset + self.RTATTR.size <= end:
+            length, kind = self.RTATTR.unpack_from(data, offset)
+            if length < self.RTATTR.size:
+                break
+            attributes[kind] = data[offset + self.RTATTR.size:offset + length]
+            offset += (length + 3) & ~3
+        return attributes
+
+class routesocketsource (object):
+    """Network change events from the BSD/OS X routing socket. Routes the
+    kernel adds by itself for ARP/ND entries and cloned host routes come and
+    go with normal traffic and are left out, as are interface messages that
+    do not change whether the interface is up and running."""
+    AF_ROUTE = getattr(socket, 'AF_ROUTE', 17)
+    RTM_ADD = 1
+    RTM_DELETE = 2
+    RTM_CHANGE = 3
+    RTM_NEWADDR = 0xc
+    RTM_DELADDR = 0xd
+    RTM_IFINFO = 0xe
+    RTF_LLINFO = 0x400
+    RTF_WASCLONED = 0x20000
+    LINK_FLAGS = 0x1 | 0x40 # IFF_UP, IFF_RUNNING
+    RTMHDR = struct.Struct('=HBB')
+    RTMSGHDR = struct.Struct('=HBBHxxi') # msglen, version, type, index, flags
+    IFMSGHDR = struct.Struct('=HBBiiH') # msglen, version, type, addrs, flags, index
+
+    def __init__ (self):
+        self.sock = socket.socket(self.AF_ROUTE, socket.SOCK_RAW, 0)
+        self.sock.setblocking(0)
+        self.links = dict() # index => up and running flags
+
+    def fileno (self):
+        return self.sock.fileno()
+
+    def read (self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        try:
+            event = self.event(data)
+        except struct.error:
+            return []
+        return [event] if event else []
+
+    def event (self, data):
+        msgtype = self.RTMHDR.unpack_from(data)[2]
+        if msgtype in (self.RTM_ADD, self.RTM_DELETE, self.RTM_CHANGE):
+            flags = self.RTMSGHDR.unpack_from(data)[4]
+            if flags & (self.RTF_LLINFO | self.RTF_WASCLONED):
+                return None
+            return ('route', None)
+        if msgtype in (self.RTM_NEWADDR, self.RTM_DELADDR):
+            return ('address', None)
+        if msgtype == self.RTM_IFINFO:
+            flags, index = self.IFMSGHDR.unpack_from(data)[4:6]
+            state = flags & self.LINK_FLAGS
+            if self.links.get(index, state) == state:
+                self.links[index] = state
+                return None
+            self.links[index] = state
+            return ('link', None)
+        return None
+
+class networkmonitor (threading.Thread):
+    """Rechecks sections when the network changes, instead of waiting for
+    their next check. source can be anything with fileno() and read(), where
+    read() returns a list of (event name, network) pairs, and an empty list
+    means nothing relevant happened. network is what the event was confined
+    to, as (family, packed address, prefix length), or None. Bursts of events
+    are debounced: the recheck happens once no event has arrived for debounce
+    seconds, and at most once every mingap seconds."""
+    def __init__ (self, source, debounce=DEFAULT_NETWORK_DEBOUNCE_SECONDS, callback=None, mingap=DEFAULT_NETWORK_MIN_GAP_SECONDS):
+        threading.Thread.__init__(self, name="networkmonitor")
+        self.daemon = True
+        self.source = source
+        self.debounce = debounce
+        self.mingap = mingap
+        self.lastrecheck = None
+        self.callback = callback or recheckOnNetworkChange
+
+    def run (self):
+        logger.info("Watching for network changes with " + self.source.__class__.__name__)
+        while True:
+            if not selfpipe.poll(self.source.fileno()):
+                continue
+            events = self.source.read()
+            if not events:
+                continue
+            while selfpipe.poll(self.source.fileno(), self.debounce):
+                events.extend(self.source.read())
+            # Whatever changes until the gap is over goes into the same recheck
+            wait = self.lastrecheck + self.mingap - time.time() if self.lastrecheck else 0
+            while wait > 0:
+                if selfpipe.poll(self.source.fileno(), wait):
+                    events.extend(self.source.read())
+                wait = self.lastrecheck + self.mingap - time.time()
+            networks = [network for name, network in events]
+            if None in networks:
+                networks = None
+            logger.info("Network changed (" + ", ".join(sorted(set(name for name, network in events))) + ").")
+            self.lastrecheck = time.time()
+            try:
+                self.callback(networks)
+            except Exception as e:
+                logger.exception(e)
+
+class histogram (object):
+    """A Prometheus style cumulative histogram."""
+    __slots__ = ('buckets', 'counts', 'count', 'total')
+
+    def __init__ (self, buckets=CHECK_DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe (self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += value
+
+    def render (self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(name + '_bucket{' + labels + ',le="' + str(bound) + '"} ' + str(cumulative))
+        lines.append(name + '_bucket{' + labels + ',le="+Inf"} ' + str(self.count))
+        lines.append(name + '_sum{' + labels + '} ' + ("%.6f" % self.total))
+        lines.append(name + '_count{' + labels + '} ' + str(self.count))
+        return lines
+
+class metricshandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET (self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = renderMetrics()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message (self, format, *args):
+        logger.debug("metrics: " + (format % args))
+
+class keychainprovider (object):
+    """Looks up reference (account, or account/service) in the OS X keychain,
+    or with secret-tool in the Secret Service keyring elsewhere."""
+    def lookup (self, reference, logPrefix=""):
+        account, slash, service = reference.partition('/')
+        if sys.platform == 'darwin':
+            cmd = "security find-generic-password -w -a " + pipes.quote(account)
+            if service:
+                cmd += " -s " + pipes.quote(service)
+        else:
+            cmd = "secret-tool lookup account " + pipes.quote(account)
+            if service:
+                cmd += " service " + pipes.quote(service)
+        rc, output = commandExecutor.execute(cmd, logPrefix, DEFAULT_HOOK_CMD_TIMEOUT, 'CREDENTIALS')
+        if rc != 0:
+            return None
+        return output.rstrip('\n')
+
+class fileprovider (object):
+    """Looks up reference in an openssl encrypted file of name=secret lines."""
+    def __init__ (self, path, keyfile):
+        self.path = path
+        self.keyfile = keyfile
+
+    def lookup (self, reference, logPrefix=""):
+        cmd = "openssl enc -d -aes-256-cbc -pbkdf2 -in " + pipes.quote(self.path) + " -pass file:" + pipes.quote(self.keyfile)
+        rc, output = commandExecutor.execute(cmd, logPrefix, DEFAULT_HOOK_CMD_TIMEOUT, 'CREDENTIALS')
+        if rc != 0:
+            logger.error("%sCould not decrypt %s", logPrefix, self.path)
+            return None
+        for line in output.splitlines():
+            name, equals, secret = line.partition('=')
+            if equals and name.strip() == reference:
+                return secret
+        return None
+
+class stubprovider (object):
+    """The reference is the secret. For testing only."""
+    def lookup (self, reference, logPrefix=""):
+        return reference
+
+class credentialcache (object):
+    """Secrets from the credential providers, kept in memory for ttl seconds
+    so that retrying a mount does not ask the keychain every time. A failed
+    mount invalidates the credentials it used."""
+    def __init__ (self, ttl=DEFAULT_CREDENTIALS_TTL_SECONDS, path=homeCredentialsFile, keyfile=homeCredentialsKeyFile):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = dict() # (provider, reference) => (secret, expires)
+        self.providers = {'keychain': keychainprovider(), 'file': fileprovider(path, keyfile), 'stub': stubprovider()}
+
+    def get (self, provider, reference, logPrefix=""):
+        key = (provider, reference)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                return entry[0]
+        if provider not in self.providers:
+            logger.error("%sUnknown credential provider %s", logPrefix, provider)
+            return None
+        secret = self.providers[provider].lookup(reference, logPrefix)
+        if secret is not None:
+            with self.lock:
+                self.entries[key] = (secret, time.time() + self.ttl)
+        return secret
+
+    def invalidate (self, credentials):
+        with self.lock:
+            for name, provider, reference in credentials:
+                self.entries.pop((provider, reference), None)
+
+    # Returns the environment for a command using credentials, or None if
+    # any of them could not be had
+    def environment (self, credentials, logPrefix=""):
+        env = dict()
+        for name, provider, reference in credentials:
+            secret = self.get(provider, reference, logPrefix)
+            if secret is None:
+                logger.error("%sCould not get credentials %s from %s", logPrefix, name, provider)
+                return None
+            env[name] = secret
+            # URL encoded, for mount_smbfs and friends
+            env[name + "_URL"] = urllib.quote(secret, safe='')
+        return env
+
+class hookdispatcher (threading.Thread):
+    """Decides which hook events run their command, and runs plugins.
+
+    HOOK_MODE level runs a section's hook command on every event, edge only
+    when MOUNT_SUCCESS turns into MOUNT_FAILURE or back (LOST_MOUNT and
+    FOUND_MOUNT are edges already), and debounce is edge but holds events
+    for HOOK_DEBOUNCE_SECONDS and runs each command once for all of them.
+    Plugins (--hookplugin) get every event that passes the section's mode,
+    as a dict, from this thread."""
+    def __init__ (self):
+        threading.Thread.__init__(self, name="hooks")
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.wakeup = selfpipe()
+        self.plugins = []
+        self.events = collections.deque() # events for plugins
+        self.batches = dict() # (kind, cmd) => [due, record, events]
+
+    def loadPlugin (self, path):
+        try:
+            plugin = imp.load_source("macmounterplugin" + str(len(self.plugins)), path)
+            self.plugins.append(plugin.handle)
+            logger.info("Loaded hook plugin " + path)
+        except Exception as e:
+            logger.error("Could not load hook plugin " + path + ": " + str(e))
+
+    def dispatch (self, record, event, cmd, kind, env=None):
+        if not running:
+            # Commands are being killed, so whatever failed now did not
+            return
+        edge = record.hookEdge(event)
+        if record.hookmode != 'level' and not edge:
+            return
+        details = record.hookEvent(event, env)
+        if self.plugins:
+            self.events.append(details)
+            self.wake()
+        if isBlank(cmd):
+            return
+        if record.hookmode == 'debounce':
+            logger.info("%sHolding %s for %s seconds.", record.logprefix, kind, record.hookdebounce)
+            with self.lock:
+                batch = self.batches.setdefault((kind, cmd), [time.time() + record.hookdebounce, record, []])
+                batch[2].append(details)
+            self.wake()
+            return
+        logger.info("%s%s specified. Running.", record.logprefix, kind)
+        record.runCommand(cmd, kind, env)
+
+    def wake (self):
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+        self.wakeup.set()
+
+    def run (self):
+        while True:
+            timeout = None
+            with self.lock:
+                due = [key for key, batch in self.batches.items() if batch[0] <= time.time()]
+                batches = [(key, self.batches.pop(key)) for key in due]
+                if self.batches:
+                    timeout = max(0, min(batch[0] for batch in self.batches.values()) - time.time())
+            while self.events:
+                self.callPlugins(self.events.popleft())
+            for (kind, cmd), (due, record, events) in batches:
+                self.runBatch(kind, cmd, record, events)
+            if not batches:
+                self.wakeup.wait(timeout)
+
+    def callPlugins (self, event):
+        for plugin in self.plugins:
+            try:
+                plugin(event)
+            except Exception as e:
+                logger.error("Hook plugin failed on " + event['event'] + " of " + event['section'] + ": " + str(e))
+
+    def runBatch (self, kind, cmd, record, events):
+        sections = []
+        for event in events:
+            if event['section'] not in sections:
+                sections.append(event['section'])
+        env = dict(events[-1]['env'])
+        env.update({'EVENT': events[-1]['event'], 'EVENT_COUNT': str(len(events)), 'SECTIONS': " ".join(sections)})
+        logger.info("Running %s once for %s events of %s", kind, len(events), ", ".join(sections))
+        runCmd(cmd, record.logprefix, record.timeouts['HOOK'], kind, env)
+
+class lifecycle (object):
+    """Shuts the daemon down. Stopping wakes every thread waiting on the
+    lifecycle, stops all sections, and kills running commands. Draining then
+    waits for checks to finish, up to a deadline."""
+    def __init__ (self):
+        self.stopping = selfpipe()
+        self.stopped = False
+        self.signals = collections.deque()
+
+    def request (self, signame):
+        # Called from signal handlers. Takes no locks and does not log.
+        if signame in ['INT', 'TERM'] and self.stopped:
+            os.write(2, "Asked to stop again. Exiting now.\n")
+            os._exit(1)
+        self.signals.append(signame)
+        if monitorWakeup:
+            monitorWakeup.set()
+
+    def handleSignals (self):
+        # Runs on the main thread, for signals caught since the last call
+        while self.signals:
+            signame = self.signals.popleft()
+            if signame == 'INT':
+                logger.info('You pressed Ctrl+C!')
+                self.stop()
+            elif signame == 'TERM':
+                logger.info('Caught signal TERM. Shutting down.')
+                self.stop()
+            elif signame == 'USR1':
+                logger.info('Caught signal USR1. Toggling the profiler.')
+                toggleProfiler()
+            elif signame == 'HUP' and running:
+                logger.info('Caught signal HUP. macmounter restarted!')
+                launchMounters(updateConfig())
+                for mounter in mounterMap.values():
+                    mounter.recheck() # This triggers the mounter to restart
+
+    def wait (self, timeout):
+        # Sleeps for up to timeout seconds. Returns True when shutting down.
+        return selfpipe.poll(self.stopping.fileno(), timeout)
+
+    def stop (self):
+        global running
+        if self.stopped:
+            logger.error("Asked to stop again. Exiting now.")
+            logging.shutdown()
+            os._exit(1)
+        self.stopped = True
+        running = False
+        self.stopping.set()
+        if monitorWakeup:
+            monitorWakeup.set()
+        if stateStore:
+            stateStore.save()
+        killMounters()
+
+    def drain (self, timeout):
+        # Returns False if checks or commands are still running at the deadline
+        deadline = time.time() + timeout
+        threads = [thread for thread in threading.enumerate() if isinstance(thread, mounter)]
+        if mounterScheduler:
+            threads.append(mounterScheduler)
+            threads.extend(mounterScheduler.workers)
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        while commandExecutor.children and time.time() < deadline:
+            commandExecutor.killAll()
+            self.wait(COMMAND_POLL_SECONDS)
+        return not [thread for thread in threads if thread.is_alive()] and not commandExecutor.children
+
+class mountrecord (object):
+     """Per-section state and check logic, shared by both engines."""
+     __slots__ = ('state', 'modifyTime', 'filename', 'section', 'logprefix', 'options', 'pendingoptions', 'mounted', 'reload', 'running',
+                  'configsmodified', 'busy', 'due', 'generation', 'currentinterval',
+                  'interval', 'intervalpingsuccess', 'intervalpingfailure', 'intervalmountsuccess', 'intervalmountfailure',
+                  'mounttestcmd', 'timeouts', 'mountpoint', 'mountfstype', 'mountsource', 'healthprobe', 'healthprobepath', 'healthprobetimeout', 'unmountcmd', 'pingcmd', 'pinghost', 'pingports', 'pingtimeout', 'pingicmp', 'pingcacheseconds',
+                  'backoffmultiplier', 'backoffmax', 'backoffjitter', 'startjitter',
+                  'adaptive', 'adaptivemin', 'adaptivemax', 'adaptivegrowth', 'adaptiveflapwindow', 'streak', 'flaps', 'host', 'breakerthreshold', 'breakercooldown', 'failures', 'optionshash', 'lastsuccess', 'lastfailure', 'resumedelay',
+                  'recheckonnetworkchange', 'dependson', 'credentials', 'outputcapture', 'outputmode', 'lastoutput', 'stale', 'hookmode', 'hookdebounce', 'lastoutcome', 'pendingoutcome', 'steps', 'parked', 'paused', 'statesince', 'lastcheck', 'lastcheckduration', 'checkdurations', 'premountcmd', 'wakecmd', 'wakeattempts', 'mountcmd', 'mountsuccesscmd',
+                  'mountfailurecmd', 'postmountcmd', 'lostmountcmd', 'foundmountcmd')
+     states = ['INIT', 'PING_SUCCESS', 'PING_FAILURE', 'MOUNT_SUCCESS', 'MOUNT_FAILURE', 'MOUNT_STALE', 'WAITING']
+
      def __init__ (self, section, filename):
-         threading.Thread.__init__( self )
-         logger.info("Setting up thread for resource " + section)
-         logger.info("Added thread to mounter map: " + section + filename + "=>" + str(self))
-         mounterMap[section + filename] = self
-         self.states = ['INIT', 'PING_SUCCESS', 'PING_FAILURE', 'MOUNT_SUCCESS', 'MOUNT_FAILURE']
+         logger.info("Setting up record for resource %s", section)
          self.state = 'INIT'
+         self.statesince = time.time()
+         self.lastcheck = None
+         self.lastcheckduration = None
+         self.checkdurations = histogram()
          self.modifyTime = os.path.getmtime(filename)
          self.filename = filename
          self.section = section
          self.logprefix = "[" + self.section + "] "
-         self.config = ConfigParser.ConfigParser()
+         self.options = None
+         self.pendingoptions = None
          self.mounted = False
          self.reload = False
+         self.paused = False
+         self.configsmodified = False
+         self.failures = 0
+         self.streak = 0
+         self.flaps = collections.deque(maxlen=ADAPTIVE_FLAP_HISTORY)
+         self.lastsuccess = None
+         self.lastfailure = None
+         self.lastoutcome = None
+         self.pendingoutcome = None
+         self.lastoutput = None
+         self.stale = False
+         self.steps = dict()
+         self.parked = False
+         self.resumedelay = None
+         self.currentinterval = None
+         self.busy = False
+         self.due = 0
+         self.generation = 0
+         self.running = True
          self.updateConfigs()
+         # Only once its options are set, other sections look at it
+         # (DEPENDS_ON) as soon as it is in the map
+         logger.info("Added record to mounter map: %s%s=>%s", section, filename, self)
+         mounterMap[section + filename] = self
+         if stateStore:
+             self.restoreState(stateStore.restore(self))
 
      # Should be called *after* changing state
      def updateCurrentInterval (self):
-         logger.info(self.logprefix + "Updating current interval in state [" + self.state + "]")
-         if self.state is 'PING_SUCCESS':
+         logger.info("%sUpdating current interval in state [%s]", self.logprefix, self.state)
+         if self.state == 'PING_SUCCESS':
              self.setCurrentInterval(self.intervalpingsuccess)
-         elif self.state is 'PING_FAILURE':
-             self.setCurrentInterval(self.intervalpingfailure)
-         elif self.state is 'MOUNT_SUCCESS':
-             self.setCurrentInterval(self.intervalmountsuccess)
-         elif self.state is 'MOUNT_FAILURE':
-             self.setCurrentInterval(self.intervalmountfailure)
+         elif self.state == 'PING_FAILURE':
+             self.setCurrentInterval(self.backoff(self.intervalpingfailure))
+         elif self.state == 'MOUNT_SUCCESS':
+             self.setCurrentInterval(self.adapt(self.intervalmountsuccess))
+         elif self.state in ['MOUNT_FAILURE', 'MOUNT_STALE']:
+             self.setCurrentInterval(self.backoff(self.intervalmountfailure))
          else:
              self.setCurrentInterval(self.interval)
 
+     # Stretches a failure interval by BACKOFF_MULTIPLIER for every consecutive
+     # failure, up to BACKOFF_MAX_SECONDS, and optionally applies full jitter
+     def backoff (self, interval):
+         if self.backoffmultiplier > 1 and self.failures > 1:
+             cap = max(interval, self.backoffmax)
+             # Stop growing the exponent once past the cap
+             interval = min(cap, interval * self.backoffmultiplier ** min(self.failures - 1, 64))
+         if self.backoffjitter:
+             interval = random.uniform(1, max(1, interval))
+         return interval
+
+     # With ADAPTIVE_INTERVAL, stretches the interval of a healthy mount by
+     # ADAPTIVE_INTERVAL_GROWTH for every check in a row that found it mounted,
+     # up to ADAPTIVE_INTERVAL_MAX_SECONDS. Once it was lost within the last
+     # ADAPTIVE_FLAP_WINDOW_SECONDS, halves it for every loss instead, down to
+     # ADAPTIVE_INTERVAL_MIN_SECONDS.
+     def adapt (self, interval):
+         if not self.adaptive:
+             return interval
+         flaps = self.recentFlaps()
+         if flaps:
+             return max(min(interval, self.adaptivemin), interval / 2.0 ** flaps)
+         if self.adaptivegrowth > 1 and self.streak > 1:
+             cap = max(interval, self.adaptivemax)
+             # Stop growing the exponent once past the cap
+             interval = min(cap, interval * self.adaptivegrowth ** min(self.streak - 1, 64))
+         return interval
+
+     def recentFlaps (self):
+         since = time.time() - self.adaptiveflapwindow
+         return len([flap for flap in self.flaps if flap >= since])
+
+     def startDelay (self):
+         if self.resumedelay is not None:
+             delay, self.resumedelay = self.resumedelay, None
+             return delay
+         if self.startjitter:
+             return random.uniform(0, self.startjitter)
+         return 0
+
      def setCurrentInterval (self, currentinterval):
-         logger.info(self.logprefix + "Setting current interval to [" + str(currentinterval) + "]")
+         logger.info("%sSetting current interval to [%s]", self.logprefix, currentinterval)
          self.currentinterval = currentinterval
 
      def changeState (self, toState):
-         if self.state not in self.states:
-             logger.error(self.logprefix + "Unknown state [" + toState + "]")
+         if toState not in self.states:
+             logger.error("%sUnknown state [%s]", self.logprefix, toState)
              return
-         logger.info(self.logprefix + "Changing state from [" + self.state + "] to [" + toState + "]")
+         logger.info("%sChanging state from [%s] to [%s]", self.logprefix, self.state, toState)
+         if toState != self.state:
+             self.statesince = time.time()
          self.state = toState
 
      def updateConfigs (self):
-         logger.info(self.logprefix + "Updating configs from file: " + self.filename + " and section: " + self.section)
-         self.config = ConfigParser.ConfigParser()
-         self.config.read(self.filename)
-         if not self.config.has_section(self.section):
-             logger.info(self.logprefix + "Section has been removed from config file.")
+         logger.info("%sUpdating configs from file: %s and section: %s", self.logprefix, self.filename, self.section)
+         parsed = readConfig(self.filename)
+         if parsed is None or self.section not in parsed.options:
+             logger.info("%sSection has been removed from config file.", self.logprefix)
              self.stop()
              return
-         self.interval = getConfig(self.config, self.section, 'RECHECK_INTERVAL_SECONDS', DEFAULT_RECHECK_INTERVAL_SECONDS, int, logPrefix=self.logprefix)
-         self.intervalpingsuccess = getConfig(self.config, self.section, 'RECHECK_INTERVAL_SECONDS_PING_SUCCESS', self.interval, int, logPrefix=self.logprefix)
-         self.intervalpingfailure = getConfig(self.config, self.section, 'RECHECK_INTERVAL_SECONDS_PING_FAILURE', self.interval, int, logPrefix=self.logprefix)
-         self.intervalmountsuccess = getConfig(self.config, self.section, 'RECHECK_INTERVAL_SECONDS_MOUNT_SUCCESS', self.interval, int, logPrefix=self.logprefix)
-         self.intervalmountfailure = getConfig(self.config, self.section, 'RECHECK_INTERVAL_SECONDS_MOUNT_FAILURE', self.interval, int, logPrefix=self.logprefix)
-         self.mounttestcmd = getConfig(self.config, self.section, 'MOUNT_TEST_CMD', DEFAULT_MOUNT_TEST_CMD, logPrefix=self.logprefix)
-         self.pingcmd = getConfig(self.config, self.section, 'PING_CMD', DEFAULT_PING_CMD, logPrefix=self.logprefix)
-         self.premountcmd = getConfig(self.config, self.section, 'PRE_MOUNT_CMD', DEFAULT_PRE_MOUNT_CMD, logPrefix=self.logprefix)
-         self.wakecmd = getConfig(self.config, self.section, 'WAKE_CMD', DEFAULT_WAKE_CMD, logPrefix=self.logprefix)
-         self.wakeattempts = getConfig(self.config, self.section, 'WAKE_ATTEMPTS', DEFAULT_WAKE_ATTEMPTS, int, logPrefix=self.logprefix)
-         self.mountcmd = getConfig(self.config, self.section, 'MOUNT_CMD', DEFAULT_MOUNT_CMD, logPrefix=self.logprefix)
-         self.mountsuccesscmd = getConfig(self.config, self.section, 'MOUNT_SUCCESS_CMD', DEFAULT_MOUNT_SUCCESS_CMD, logPrefix=self.logprefix)
-         self.mountfailurecmd = getConfig(self.config, self.section, 'MOUNT_FAILURE_CMD', DEFAULT_MOUNT_FAILURE_CMD, logPrefix=self.logprefix)
-         self.postmountcmd = getConfig(self.config, self.section, 'POST_MOUNT_CMD', DEFAULT_POST_MOUNT_CMD, logPrefix=self.logprefix)
-         self.lostmountcmd = getConfig(self.config, self.section, 'LOST_MOUNT_CMD', DEFAULT_LOST_MOUNT_CMD, logPrefix=self.logprefix)
-         self.foundmountcmd = getConfig(self.config, self.section, 'FOUND_MOUNT_CMD', DEFAULT_FOUND_MOUNT_CMD, logPrefix=self.logprefix)
+         self.modifyTime = parsed.mtime
+         self.applyOptions(parsed.options[self.section])
+
+     def applyOptions (self, options):
+         self.options = options
+         self.optionshash = hashlib.sha1(json.dumps(options, sort_keys=True)).hexdigest()
+         for name, value in options.items():
+             setattr(self, name, value)
 
      def stop (self):
-         logger.info(self.logprefix + "Stopping thread: " + str(threading.current_thread()))
+         logger.info("%sStopping thread: %s", self.logprefix, threading.current_thread())
          self.running = False
+         if mounterScheduler:
+             mounterScheduler.schedule(self, 0)
+
+     def recheck (self):
+         self.reload = True
+         if mounterScheduler:
+             mounterScheduler.schedule(self, 0)
+
+     def pause (self):
+         logger.info("%sPaused.", self.logprefix)
+         self.paused = True
+
+     def resume (self):
+         logger.info("%sResumed.", self.logprefix)
+         self.paused = False
+         self.recheck()
+
+     def status (self):
+         return {'section': self.section, 'file': self.filename, 'state': self.state, 'mounted': self.mounted,
+                 'paused': self.paused, 'interval': self.currentinterval, 'statesince': self.statesince,
+                 'lastcheck': self.lastcheck, 'lastcheckduration': self.lastcheckduration,
+                 'lastsuccess': self.lastsuccess, 'lastfailure': self.lastfailure, 'dependson': self.dependson,
+                 'lastoutput': self.lastoutput, 'stale': self.stale, 'adaptive': self.adaptive, 'streak': self.streak, 'recentflaps': self.recentFlaps()}
+
+     def statekey (self):
+         return self.filename + "[" + self.section + "]"
+
+     def snapshot (self):
+         return {'state': self.state, 'statesince': self.statesince, 'mounted': self.mounted, 'failures': self.failures,
+                 'lastsuccess': self.lastsuccess, 'lastfailure': self.lastfailure, 'confighash': self.optionshash,
+                 'streak': self.streak, 'flaps': list(self.flaps)}
+
+     def restoreState (self, snapshot):
+         if not snapshot or snapshot.get('state') not in self.states:
+             return
+         if snapshot['mounted'] and isNotBlank(self.mountpoint) and not mountTable.isMounted(self.mountpoint, self.mountfstype, self.mountsource):
+             logger.info("%sSaved state says mounted, but it is not. Not restoring it.", self.logprefix)
+             return
+         logger.info("%sRestoring saved state [%s] mounted [%s]", self.logprefix, snapshot['state'], snapshot['mounted'])
+         self.state = str(snapshot['state'])
+         self.statesince = snapshot['statesince']
+         self.mounted = snapshot['mounted']
+         self.failures = snapshot['failures']
+         self.lastsuccess = snapshot['lastsuccess']
+         self.lastfailure = snapshot['lastfailure']
+         self.streak = snapshot.get('streak', 0)
+         self.flaps.extend(snapshot.get('flaps', []))
+         self.lastoutcome = 'MOUNT_SUCCESS' if self.mounted else None
+         self.updateCurrentInterval()
+         if self.mounted and isBlank(self.mountpoint):
+             # Only a check can tell whether it is still mounted. Logging out
+             # unmounts shares without a reboot, so check right away.
+             return
+         # Nothing needs doing right away, so spread the first checks over
+         # the interval instead of checking every section at once
+         self.resumedelay = random.uniform(0, self.currentinterval)
+
+     # Returns False if the config file is gone
+     def pollConfigs (self):
+         self.configsmodified = False
+         pending = self.pendingoptions
+         self.pendingoptions = None
+         if pending:
+             modifyTime, options = pending
+         else:
+             try:
+                 modifyTime = os.path.getmtime(self.filename)
+             except OSError as e:
+                 logger.error(e)
+                 logger.info("File %s is gone!", self.filename)
+                 return False
+             if modifyTime <= self.modifyTime:
+                 return True
+             parsed = readConfig(self.filename)
+             if parsed is None:
+                 logger.info("File %s is gone!", self.filename)
+                 return False
+             if self.section not in parsed.options:
+                 logger.info("%sSection has been removed from config file.", self.logprefix)
+                 self.stop()
+                 return True
+             modifyTime, options = parsed.mtime, parsed.options[self.section]
+         if options != self.options:
+             logger.info("%sConfigs have changed!", self.logprefix)
+             logger.info("%snew config time: %s", self.logprefix, time.ctime(modifyTime))
+             logger.info("%sold config time: %s", self.logprefix, time.ctime(self.modifyTime))
+             self.applyOptions(options)
+             self.configsmodified = True
+         self.modifyTime = modifyTime
+         return True
+
+     def retire (self):
+         logger.info("%sHasta La Vista. Baby.", self.logprefix)
+         with mounterMapLock:
+             # The section may have been added back in the meantime
+             if mounterMap.get(self.section + self.filename) is self:
+                 del mounterMap[self.section + self.filename]
+         if stateStore and running:
+             stateStore.wakeup.set()
+         logger.info("Removed thread from mounter map: %s%s", self.section, self.filename)
 
      def mountFailure (self, reason=""):
-         logger.info(self.logprefix + "Mount failure!")
-         if isNotBlank(self.mountfailurecmd):
-             logger.info(self.logprefix + "Mount failure command specified. Running.")
-             runCmd("export REASON=\"" + reason + "\"; " + self.mountfailurecmd, self.logprefix)
+         if not running:
+             return
+         logger.info("%sMount failure!", self.logprefix)
+         # The end of what the failed command printed, if anything failed
+         output = self.lastoutput or ""
+         if output and self.outputmode != 'log':
+             logger.info("%sOutput of the failed command: %s", self.logprefix, output)
+         self.outcome('MOUNT_FAILURE', self.mountfailurecmd, 'MOUNT_FAILURE_CMD', {'REASON': reason, 'OUTPUT': output})
+         lost = self.mounted
          if self.mounted:
-             if isNotBlank(self.lostmountcmd):
-                 logger.info(self.logprefix + "Lost mount command specified. Running.")
-                 runCmd("export REASON=\"" + reason + "\"; " + self.lostmountcmd, self.logprefix)
+             self.flaps.append(time.time())
+             hookDispatcher.dispatch(self, 'LOST_MOUNT', self.lostmountcmd, 'LOST_MOUNT_CMD', {'REASON': reason, 'OUTPUT': output})
          self.mounted = False
+         if lost:
+             # Whatever was mounted on top of us is gone too
+             self.triggerDependents()
 
      def mountSuccess (self):
-         logger.info(self.logprefix + "Mount success!")
-         if isNotBlank(self.mountsuccesscmd):
-             logger.info(self.logprefix + "Mount success command specified. Running.")
-             runCmd(self.mountsuccesscmd, self.logprefix)
+         logger.info("%sMount success!", self.logprefix)
+         self.outcome('MOUNT_SUCCESS', self.mountsuccesscmd, 'MOUNT_SUCCESS_CMD')
+         found = not self.mounted
          if not self.mounted:
-             if isNotBlank(self.foundmountcmd):
-                 logger.info(self.logprefix + "Found mount command specified. Running.")
-                 runCmd(self.foundmountcmd, self.logprefix)
+             hookDispatcher.dispatch(self, 'FOUND_MOUNT', self.foundmountcmd, 'FOUND_MOUNT_CMD')
          self.mounted = True
+         if found:
+             self.triggerDependents()
+
+     # With HOOK_MODE level, every success or failure runs its hook right away.
+     # Otherwise only the last one of a check counts (a failed test is usually
+     # followed by a failed mount, with its reason and output), and is
+     # dispatched when the check is done.
+     def outcome (self, event, cmd, kind, env=None):
+         if self.hookmode == 'level':
+             hookDispatcher.dispatch(self, event, cmd, kind, env)
+         else:
+             self.pendingoutcome = (event, cmd, kind, env)
+
+     # Returns True if event is a change from the last success or failure
+     def hookEdge (self, event):
+         if event not in ['MOUNT_SUCCESS', 'MOUNT_FAILURE']:
+             return True
+         changed = event != self.lastoutcome
+         self.lastoutcome = event
+         return changed
+
+     def hookEvent (self, event, env=None):
+         env = env or dict()
+         return {'event': event, 'section': self.section, 'file': self.filename, 'state': self.state, 'mounted': self.mounted,
+                 'host': self.host, 'reason': env.get('REASON'), 'output': env.get('OUTPUT'), 'time': time.time(), 'env': env}
+
+     def triggerDependents (self):
+         for dependent in getDependents(self):
+             logger.info("%sRechecking dependent section %s", self.logprefix, dependent.section)
+             dependent.recheck()
+
+     # Returns the prerequisites (DEPENDS_ON) that are not mounted
+     def unmetDependencies (self):
+         if not self.dependson:
+             return []
+         if self.inDependencyCycle():
+             logger.error("%sDEPENDS_ON of this section is circular. Ignoring it.", self.logprefix)
+             return []
+         return [section for section in self.dependson if not [record for record in selectMounters(section) if record.mounted]]
+
+     def inDependencyCycle (self):
+         seen = set()
+         pending = list(self.dependson)
+         while pending:
+             section = pending.pop()
+             if section == self.section:
+                 return True
+             if section not in seen:
+                 seen.add(section)
+                 for record in selectMounters(section):
+                     pending.extend(record.dependson or ())
+         return False
+
+     # Returns True if the section has to wait for its prerequisites. Those
+     # recheck it once they are mounted.
+     def waitOnDependencies (self):
+         unmet = self.unmetDependencies()
+         if not unmet:
+             return False
+         logger.info("%sWaiting for %s to be mounted first.", self.logprefix, ", ".join(unmet))
+         if self.mounted:
+             self.mountFailure("Prerequisite " + unmet[0] + " is not mounted.")
+         self.changeState('WAITING')
+         return True
+
+     def mount (self):
+         env = None
+         if self.credentials:
+             with tracespan('CREDENTIALS', 'step', {'section': self.section}):
+                 env = credentialCache.environment(self.credentials, self.logprefix)
+             if env is None:
+                 return False
+         # At most --mountconcurrency mounts run at the same time
+         if mountSlots is None:
+             mounted = self.runCommand(self.mountcmd, 'MOUNT_CMD', env)
+         else:
+             with tracespan('MOUNT_SLOT_WAIT', 'step', {'section': self.section}):
+                 mountSlots.acquire()
+             try:
+                 mounted = self.runCommand(self.mountcmd, 'MOUNT_CMD', env)
+             finally:
+                 mountSlots.release()
+         if not mounted and self.credentials:
+             # Maybe the password changed
+             credentialCache.invalidate(self.credentials)
+         return mounted
+
+     def ping (self):
+         if isNotBlank(self.pinghost):
+             logger.info("%sProbing %s ports %s icmp %s", self.logprefix, self.pinghost, self.pingports, self.pingicmp)
+             start = time.time()
+             with tracespan('PING_PROBE', 'step', {'section': self.section, 'host': self.pinghost}) as span:
+                 reachable = reachabilityProber.probe(self.pinghost, self.pingports, self.pingtimeout, self.pingicmp)
+                 span.args['reachable'] = reachable
+             if reachable is not None:
+                 self.steps['ping'] = (time.time() - start, 0 if reachable else 1)
+                 logger.info("%sProbe %s", self.logprefix, "succeeded" if reachable else "failed")
+                 return reachable
+             logger.error("%sCannot probe %s: ICMP is not permitted here. Set PING_PORT to probe it over TCP.", self.logprefix, self.pinghost)
+             if isBlank(self.pingcmd):
+                 logger.error("%sNo PING_CMD to fall back to either. Assuming %s is up.", self.logprefix, self.pinghost)
+                 return True
+         return self.runCommand(self.pingcmd, 'PING_CMD')
+
+     def runCommand (self, cmd, kind, env=None):
+         return self.captureCommand(cmd, kind, env) == 0
+
+     # Returns the command's rc, and keeps its output if it failed
+     def captureCommand (self, cmd, kind, env=None):
+         if not cmd:
+             return None
+         timeout = self.timeouts.get(kind, self.timeouts['HOOK'])
+         start = time.time()
+         with tracespan(kind, 'command', {'section': self.section}) as span:
+             rc, output = captureCommand(cmd, self.logprefix, timeout, kind, env, self.outputcapture, self.outputmode)
+             span.args['rc'] = rc
+         if kind in HISTORY_STEPS:
+             self.steps[HISTORY_STEPS[kind]] = (time.time() - start, rc)
+         if rc != 0:
+             self.lastoutput = output
+         return rc
+
+     def reachabilityKey (self):
+         if isNotBlank(self.pinghost):
+             return (self.pinghost, self.pingports, self.pingicmp, self.wakecmd, self.wakeattempts)
+         return (self.pingcmd, self.wakecmd, self.wakeattempts)
+
+     def pingAndWake (self):
+         if isBlank(self.wakecmd):
+             logger.info("%sPING! Houston do you copy?", self.logprefix)
+             return self.ping()
+         logger.info("%sWake command specified.", self.logprefix)
+         wakeAttempts = self.wakeattempts
+         while (True):
+             logger.info("%sPING! Houston do you copy?", self.logprefix)
+             if self.ping():
+                 return True
+             logger.info("%sPing failed! Wake attempts left: %s", self.logprefix, wakeAttempts)
+             if (wakeAttempts == 0):
+                 return False
+             logger.info("%sNow try to wake the resource up.", self.logprefix)
+             self.runCommand(self.wakecmd, 'WAKE_CMD')
+             wakeAttempts -= 1
+
+     # Returns one of MOUNTED, NOT_MOUNTED or STALE (mounted, but hung or erroring)
+     def testMount (self):
+         if isNotBlank(self.mountpoint):
+             logger.info("%sMount point specified. Looking up %s in mount table.", self.logprefix, self.mountpoint)
+             if not mountTable.isMounted(self.mountpoint, self.mountfstype, self.mountsource):
+                 logger.info("%sMount point not mounted as expected.", self.logprefix)
+                 return 'NOT_MOUNTED'
+         if self.healthprobe and isNotBlank(self.healthprobepath):
+             logger.info("%sHealth probe specified. Probing %s", self.logprefix, self.healthprobepath)
+             with tracespan('HEALTH_PROBE', 'step', {'section': self.section}):
+                 healthy = healthProber.check(self.healthprobepath, self.healthprobetimeout, self.logprefix)
+             if not healthy:
+                 return 'STALE'
+         if isNotBlank(self.mounttestcmd):
+             logger.info("%sMount test command specified.", self.logprefix)
+             rc = self.captureCommand(self.mounttestcmd, 'MOUNT_TEST_CMD')
+             if rc is None:
+                 # A test that hangs is talking to a filesystem that hangs
+                 return 'STALE'
+             return 'MOUNTED' if rc == 0 else 'NOT_MOUNTED'
+         return 'MOUNTED'
+
+     def unmountStale (self):
+         logger.info("%sResource is mounted but not responding.", self.logprefix)
+         # For history: remounting moves the state on within the same check
+         self.steps['stale'] = True
+         self.mountFailure("Mount is stale.")
+         self.changeState('MOUNT_STALE')
+         if isNotBlank(self.unmountcmd):
+             logger.info("%sUnmount command specified. Running.", self.logprefix)
+             if not self.runCommand(self.unmountcmd, 'UNMOUNT_CMD'):
+                 logger.info("%sUnmount command failed!", self.logprefix)
+             mountTable.invalidate()
+
+     def check (self):
+         if self.paused:
+             self.reload = False
+             self.parked = False
+             logger.info("%sPaused. Not checking.", self.logprefix)
+             return
+         start = time.time()
+         fromstate = self.state
+         logContext.record = self
+         try:
+             self.reload = False
+             if not self.parked:
+                 # A parked check resumes where it left off
+                 self.pendingoutcome = None
+                 self.steps = dict()
+             self.lastoutput = None
+             logger.info("%sWorking on section [%s] from file [%s]", self.logprefix, self.section, self.filename)
+             if isBlank(self.mountcmd):
+                 #First make sure we have a mount command.
+                 logger.info("%sNo mount command specified. Nothing to do for", self.logprefix)
+             elif self.waitOnDependencies():
+                 logger.info("%sWill not test or mount until then.", self.logprefix)
+             else:
+                 if self.parked:
+                     # Back from waiting on another section's ping. The mount
+                     # was tested before that.
+                     self.parked = False
+                 elif isBlank(self.mounttestcmd) and isBlank(self.mountpoint):
+                     logger.info("%sNo mount test command specified. Can't test mount. Assume not mounted.", self.logprefix)
+                     # Assume not mounted!
+                 else:
+                     with tracespan('TEST', 'step', {'section': self.section}) as span:
+                         mountStatus = self.testMount()
+                         span.args['status'] = mountStatus
+                     if not running:
+                         # The test was killed, it did not fail
+                         return
+                     self.stale = mountStatus == 'STALE'
+                     if mountStatus == 'MOUNTED':
+                         # Resource is already mounted. Do nothing.
+                         logger.info("%sResource is already mounted. Nothing to do.", self.logprefix)
+                         self.mountSuccess()
+                         self.changeState('MOUNT_SUCCESS')
+                     elif mountStatus == 'STALE':
+                         self.unmountStale()
+                     else:
+                         logger.info("%sResource is no longer mounted.", self.logprefix)
+                         self.mountFailure()
+                         self.changeState('MOUNT_FAILURE')
+                 if not self.mounted:
+                     # Resource is not mounted.
+                     logger.info("%sResource is NOT mounted. Lets get to work.", self.logprefix)
+                     pingSuccess = False
+                     if isNotBlank(self.pingcmd) or isNotBlank(self.pinghost):
+                         logger.info("%sPing command specified.", self.logprefix)
+                         if mounterScheduler and reachabilityCache.park(self.reachabilityKey(), self.recheck):
+                             # A worker is not held up for the whole ping (and
+                             # wake) of another section. That one rechecks us.
+                             logger.info("%sHost is being pinged for another section. Waiting for that.", self.logprefix)
+                             self.parked = True
+                             return
+                         # Sections pinging the same host share one ping (and
+                         # wake) and its result for PING_CACHE_SECONDS
+                         with tracespan('PING', 'step', {'section': self.section}):
+                             reachable = reachabilityCache.check(self.reachabilityKey(), self.pingcacheseconds, self.pingAndWake, self.logprefix)
+                         if not running:
+                             return
+                         if reachable:
+                             logger.info("%sPing successful.", self.logprefix)
+                             self.changeState('PING_SUCCESS')
+                             pingSuccess = True
+                         else:
+                             self.mountFailure("Ping failed.")
+                             self.changeState('PING_FAILURE')
+                             logger.info("%sResource is down. Will not attempt mount.", self.logprefix)
+                     else:
+                         # No ping command, we assume ping suceeds, and
+                         # we force mounting process
+                         logger.info("%sPing command not specified. Assuming success.", self.logprefix)
+                         pingSuccess = True
+                     
+                     if pingSuccess and not mountBreaker.allow(self.host, self.breakerthreshold, self.breakercooldown):
+                         logger.info("%sCircuit breaker for host %s is open. Will not attempt mount.", self.logprefix, self.host)
+                         self.mountFailure("Circuit breaker open.")
+                         self.changeState('MOUNT_FAILURE')
+                     elif pingSuccess:
+                         if isNotBlank(self.premountcmd):
+                             logger.info("%sPre mount command specified. Running.", self.logprefix)
+                             if not self.runCommand(self.premountcmd, 'PRE_MOUNT_CMD'):
+                                 logger.info("%sPre mount command failed!", self.logprefix)
+
+                         logger.info("%sMounting...", self.logprefix)
+                         mounted = self.mount()
+                         if not running:
+                             return
+                         if not mounted:
+                             mountBreaker.failure(self.host, self.breakerthreshold)
+                             self.mountFailure("Mount failed.")
+                             self.changeState('MOUNT_FAILURE')
+                         else:
+                             mountBreaker.success(self.host)
+                             self.mountSuccess()
+                             self.changeState('MOUNT_SUCCESS')
+
+                         if isNotBlank(self.postmountcmd):
+                             logger.info("%sPost mount command specified. Running.", self.logprefix)
+                             if not self.runCommand(self.postmountcmd, 'POST_MOUNT_CMD'):
+                                 logger.info("%sPost Mount command failed!", self.logprefix)
+             if self.state in ['PING_FAILURE', 'MOUNT_FAILURE', 'MOUNT_STALE']:
+                 self.failures += 1
+                 self.streak = 0
+                 self.lastfailure = time.time()
+             else:
+                 self.failures = 0
+                 if self.mounted:
+                     self.streak += 1
+                     self.lastsuccess = time.time()
+             self.updateCurrentInterval()
+             logger.info("%sNext test after %s seconds", self.logprefix, self.currentinterval)
+         except Exception as e:
+             logger.error("Caught exception! Logging and continuing...")
+             logger.error(e)
+             logger.exception(e)
+         finally:
+             self.lastcheck = time.time()
+             self.lastcheckduration = self.lastcheck - start
+             self.checkdurations.observe(self.lastcheckduration)
+             logger.info("%sCheck took %.3f seconds", self.logprefix, self.lastcheckduration, extra={'duration': self.lastcheckduration})
+             if traceWriter:
+                 traceWriter.add('check', 'check', start, self.lastcheckduration, {'section': self.section, 'file': self.filename, 'from': fromstate, 'to': self.state})
+             if self.pendingoutcome and running and not self.parked:
+                 hookDispatcher.dispatch(self, *self.pendingoutcome)
+                 self.pendingoutcome = None
+             logContext.record = None
+             if stateStore:
+                 stateStore.changed(self)
+             if historyStore and running and not self.parked:
+                 historyStore.record(self, start, fromstate, self.lastcheckduration)
+
+class mounter (mountrecord, threading.Thread):
+     """Thread engine: one thread per section, waking every second."""
+     def __init__ (self, section, filename):
+         # Named after the section, for profiles and traces
+         threading.Thread.__init__( self, name=section )
+         # Shutdown joins mounters itself, with a deadline
+         self.daemon = True
+         mountrecord.__init__(self, section, filename)
 
      def run (self):
-         seconds = 0
+         nextcheck = time.time() + self.startDelay()
          self.updateCurrentInterval()
-         self.running = True
          while self.running:
-             try:
-                 modifyTime = os.path.getmtime(self.filename)
-                 if modifyTime > self.modifyTime:
-                     logger.info(self.logprefix + "Configs have changed!")
-                     logger.info(self.logprefix + "new config time: " + time.ctime(modifyTime))
-                     logger.info(self.logprefix + "old config time: " + time.ctime(self.modifyTime))
-                     self.updateConfigs()
-                     self.modifyTime = modifyTime
-                     self.configsmodified = True
-                 else:
-                     self.configsmodified = False
-             except Exception as e:
-                 logger.error(e)
-                 logger.info("File " + self.filename + " is gone!")
+             # Under a config watcher, changes are pushed to us as a recheck
+             if (configWatcher is None or self.reload) and not self.pollConfigs():
                  break
-             if (seconds % self.currentinterval == 0) or self.configsmodified or self.reload:
-                 try:
-                     self.reload = False
-                     logger.info(self.logprefix + "Working on section [" + self.section + "] from file [" + self.filename + "]")
-                     if isBlank(self.mountcmd):
-                         #First make sure we have a mount command.
-                         logger.info(self.logprefix + "No mount command specified. Nothing to do for")
-                     else:
-                         if isBlank(self.mounttestcmd):
-                             logger.info(self.logprefix + "No mount test command specified. Can't test mount. Assume not mounted.")
-                             # Assume not mounted!
-                         else:
-                             logger.info(self.logprefix + "Mount test command specified.")
-                             if runCmd(self.mounttestcmd, self.logprefix):
-                                 # Resource is already mounted. Do nothing.
-                                 logger.info(self.logprefix + "Resource is already mounted. Nothing to do.")
-                                 self.mountSuccess()
-                                 self.changeState('MOUNT_SUCCESS')
-                             else:
-                                 logger.info(self.logprefix + "Resource is no longer mounted.")
-                                 self.mountFailure()
-                                 self.changeState('MOUNT_FAILURE')
-                         if not self.mounted:
-                             # Resource is not mounted.
-                             logger.info(self.logprefix + "Resource is NOT mounted. Lets get to work.")
-                             pingSuccess = False
-                             if isNotBlank(self.pingcmd):
-                                 logger.info(self.logprefix + "Ping command specified.")
-                                 if isNotBlank(self.wakecmd):
-                                     logger.info(self.logprefix + "Wake command specified.")
-                                     wakeAttempts = self.wakeattempts
-                                     while (True):
-                                         logger.info(self.logprefix + "PING! Houston do you copy?")
-                                         if not runCmd(self.pingcmd, self.logprefix):
-                                             logger.info(self.logprefix + "Ping failed! Wake attempts left: " + str(wakeAttempts))
-                                             if (wakeAttempts == 0):
-                                                 self.mountFailure("Ping failed.")
-                                                 self.changeState('PING_FAILURE')
-                                                 break
-                                             logger.info(self.logprefix + "Now try to wake the resource up.")
-                                             runCmd(self.wakecmd, self.logprefix)
-                                             wakeAttempts -= 1
-                                         else:
-                                             logger.info(self.logprefix + "Ping successful.")
-                                             self.changeState('PING_SUCCESS')
-                                             pingSuccess = True
-                                             break
-                                 else:
-                                     logger.info(self.logprefix + "PING! Houston do you copy?")
-                                     if runCmd(self.pingcmd, self.logprefix):
-                                         logger.info(self.logprefix + "Ping successful.")
-                                         self.changeState('PING_SUCCESS')
-                                         pingSuccess = True
-                                     else:
-                                         self.mountFailure("Ping failed.")
-                                         self.changeState('PING_FAILURE')
-                                         logger.info(self.logprefix + "Resource is down. Will not attempt mount.")
-                             else:
-                                 # No ping command, we assume ping suceeds, and
-                                 # we force mounting process
-                                 logger.info(self.logprefix + "Ping command not specified. Assuming success.")
-                                 pingSuccess = True
-                             
-                             if pingSuccess:
-                                 if isNotBlank(self.premountcmd):
-                                     logger.info(self.logprefix + "Pre mount command specified. Running.")
-                                     if not runCmd(self.premountcmd, self.logprefix):
-                                         logger.info(self.logprefix + "Pre mount command failed!")
-
-                                 logger.info(self.logprefix + "Mounting...")
-                                 if not runCmd(self.mountcmd, self.logprefix):
-                                     self.mountFailure("Mount failed.")
-                                     self.changeState('MOUNT_FAILURE')
-                                 else:
-                                     self.mountSuccess()
-                                     self.changeState('MOUNT_SUCCESS')
-
-                                 if isNotBlank(self.postmountcmd):
-                                     logger.info(self.logprefix + "Post mount command specified. Running.")
-                                     if not runCmd(self.postmountcmd, self.logprefix):
-                                         logger.info(self.logprefix + "Post Mount command failed!")
-                     self.updateCurrentInterval()
-                     logger.info(self.logprefix + "Next test after " + str(self.currentinterval) + " seconds")
-                 except Exception as e:
-                     logger.error("Caught exception! Logging and continuing...")
-                     logger.error(e)
-                     logger.exception(e)
-             time.sleep(float(1))
-             seconds += 1
-         logger.info(self.logprefix + "Hasta La Vista. Baby.")
-         mounterMap.pop(self.section + self.filename, None)
-         logger.info("Removed thread from mounter map: " + self.section + self.filename)
+             if time.time() >= nextcheck or self.configsmodified or self.reload:
+                 self.check()
+                 nextcheck = time.time() + self.currentinterval
+             daemonLifecycle.wait(1)
+         self.retire()
+
+class scheduler (threading.Thread):
+    """Scheduler engine: a single timer heap dispatching due checks to a small
+    pool of workers. Idle sections cost nothing until their check is due."""
+    def __init__ (self, workers=DEFAULT_SCHEDULER_WORKERS):
+        threading.Thread.__init__(self, name="scheduler")
+        self.daemon = True
+        self.heap = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.wakeup = selfpipe()
+        self.queue = Queue.Queue()
+        self.running = True
+        self.workers = []
+        for i in range(max(1, workers)):
+            worker = threading.Thread(target=self.work, name="scheduler-worker-" + str(i))
+            worker.daemon = True
+            self.workers.append(worker)
+
+    def start (self):
+        for worker in self.workers:
+            worker.start()
+        threading.Thread.start(self)
+
+    def stop (self):
+        self.running = False
+        self.wake()
+
+    def wake (self):
+        self.wakeup.set()
+
+    def add (self, record):
+        record.updateCurrentInterval()
+        self.schedule(record, record.startDelay())
+
+    def schedule (self, record, delay):
+        with self.lock:
+            record.due = time.time() + delay
+            record.generation += 1
+            heapq.heappush(self.heap, (record.due, next(self.counter), record.generation, record))
+        self.wake()
+
+    def run (self):
+        logger.info("Scheduler started.")
+        while self.running:
+            timeout = None
+            now = time.time()
+            retired = []
+            with self.lock:
+                while self.heap:
+                    due, count, generation, record = self.heap[0]
+                    if generation != record.generation:
+                        # Superseded by a later schedule() call
+                        heapq.heappop(self.heap)
+                        continue
+                    if not record.running:
+                        heapq.heappop(self.heap)
+                        if not record.busy:
+                            retired.append(record)
+                        continue
+                    if due > now:
+                        timeout = due - now
+                        break
+                    heapq.heappop(self.heap)
+                    if not record.busy:
+                        record.busy = True
+                        self.queue.put(record)
+            # retire() takes mounterMapLock, which launchMounters() holds
+            # while scheduling, so never call it under the heap lock
+            for record in retired:
+                record.retire()
+            self.wakeup.wait(timeout)
+        for worker in self.workers:
+            self.queue.put(None)
+        logger.info("Scheduler stopped.")
+
+    def work (self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            try:
+                if record.running:
+                    if record.pollConfigs():
+                        record.check()
+                    else:
+                        # The file is gone, as in the thread engine
+                        record.stop()
+            finally:
+                with self.lock:
+                    record.busy = False
+                if not record.running or not self.running:
+                    record.retire()
+                elif record.reload:
+                    self.schedule(record, 0)
+                else:
+                    self.schedule(record, record.currentinterval)
+
+mountTable = mounttable()
+reachabilityProber = prober()
+reachabilityCache = reachability()
+commandExecutor = executor()
+healthProber = healthprober()
+mountBreaker = circuitbreaker()
+daemonLifecycle = lifecycle()
+hookDispatcher = hookdispatcher()
+credentialCache = credentialcache()
 
 # Register signal handler
 signal.signal(signal.SIGINT, ctrlc_handler)
 signal.signal(signal.SIGHUP, hup_handler)
+signal.signal(signal.SIGTERM, term_handler)
+signal.signal(signal.SIGUSR1, usr1_handler)
 
 if __name__ == "__main__":  crux()